@@ -1,6 +1,6 @@
 #!/bin/dash
 pip install -e git+https://github.com/eol-uchile/uchileedxlogin@1.0.0#egg=uchileedxlogin
-pip install -e /openedx/requirements/app
+pip install -e "/openedx/requirements/app[parquet,xlsx]"
 pip install pytest-cov genbadge[coverage]
 
 cd /openedx/requirements/app
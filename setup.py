@@ -9,6 +9,11 @@ setuptools.setup(
     url="https://eol.uchile.cl",
     packages=setuptools.find_packages(),
     install_requires=["unidecode>=1.1.1"],
+    extras_require={
+        # output=parquet and output=xlsx of the reports
+        "parquet": ["pyarrow"],
+        "xlsx": ["openpyxl"],
+    },
     classifiers=[
         "Programming Language :: Python :: 2",
         "License :: OSI Approved :: MIT License",
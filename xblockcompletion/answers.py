@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+# Python Standard Libraries
+import logging
+import threading
+import weakref
+from itertools import groupby
+from operator import itemgetter
+
+# Installed packages (via pip)
+from celery import task
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+# Edx dependencies
+from lms.djangoapps.courseware.models import StudentModule
+from xmodule.modulestore.django import modulestore
+
+# Internal project dependencies
+from .models import XblockCompletionAnswer
+from .views import ReportBlock, XblockCompletionView
+
+logger = logging.getLogger(__name__)
+
+# AnswersBatch of the current transaction, see queue_answers_update
+_pending = threading.local()
+
+def update_block_answers(view, course_key, block_item, student_states):
+    """
+    Replace the XblockCompletionAnswer rows of the students of `student_states` in a
+    problem block with the rows of both report formats built from their states
+    """
+    answers = []
+    student_ids = []
+    for response in student_states:
+        student_ids.append(response['student__id'])
+        if '"attempts"' not in (response['state'] or ''):
+            continue
+        # the doc_id is resolved when the report is read
+        response = dict(response, doc_id='')
+        fields = {
+            'course_id': course_key,
+            'block_id': block_item.location,
+            'student_id': response['student__id'],
+            'modified': response['modified'],
+        }
+        report = view.get_resumen_report(block_item, response)
+        if report is not None:
+            answers.append(XblockCompletionAnswer(report_format='resumen', **dict(fields, **report)))
+        for position, report in enumerate(view.generate_report_data(block_item, [response])):
+            answers.append(XblockCompletionAnswer(
+                report_format='all',
+                position=position,
+                answer_id=report['answer_id'],
+                question=report['question'],
+                answer=report['answer'],
+                correct_answer=report['correct_answer'],
+                attempts=report['attempts'] if report['attempts'] != '' else None,
+                gained=report['gained'],
+                possible=report['possible'],
+                total=report['total'],
+                has_saved_answers=bool(report['has_saved_answers']),
+                state=report['state'],
+                **fields))
+    with transaction.atomic():
+        XblockCompletionAnswer.objects.filter(
+            course_id=course_key,
+            block_id=block_item.location,
+            student_id__in=student_ids).delete()
+        XblockCompletionAnswer.objects.bulk_create(answers, batch_size=getattr(settings, 'XBLOCKCOMPLETION_CHUNK_SIZE', 2000))
+    return len(answers)
+
+def backfill_course_answers(course_key, modified_since=None):
+    """
+    Build the XblockCompletionAnswer rows of all the students of a course (the reports
+    filter the enrolled students when they are read), of the states modified since
+    `modified_since` if it is given
+    """
+    view = XblockCompletionView()
+    store = modulestore()
+    rows = 0
+    states = StudentModule.objects.filter(
+        course_id=course_key,
+        module_type='problem',
+        state__contains='attempts')
+    if modified_since is not None:
+        states = states.filter(modified__gte=modified_since)
+    states = states.values(
+        'module_state_key', 'student__id', 'student__username', 'student__email',
+        'grade', 'max_grade', 'modified', 'state').order_by('module_state_key', 'student__id')
+    chunk_size = getattr(settings, 'XBLOCKCOMPLETION_CHUNK_SIZE', 2000)
+    with store.bulk_operations(course_key):
+        outline = view.get_course_outline(course_key, store)
+        blocks = view.get_report_blocks(course_key, store, outline)
+        for block_key, student_states in groupby(states.iterator(chunk_size=chunk_size), key=itemgetter('module_state_key')):
+            block_item = blocks.get(block_key)
+            if block_item is None:
+                continue
+            rows += update_block_answers(view, course_key, block_item, student_states)
+    return rows
+
+@task(queue='edx.lms.core.low')
+def update_materialized_answers(student_module_ids):
+    """
+    Update the XblockCompletionAnswer rows of a batch of StudentModule rows
+    """
+    states = StudentModule.objects.filter(id__in=student_module_ids, module_type='problem').values(
+        'course_id', 'module_state_key', 'student__id', 'student__username', 'student__email',
+        'grade', 'max_grade', 'modified', 'state').order_by('course_id', 'module_state_key', 'student__id')
+    view = XblockCompletionView()
+    store = modulestore()
+    for (course_key, block_key), student_states in groupby(states, key=itemgetter('course_id', 'module_state_key')):
+        try:
+            block_item = ReportBlock.from_xblock(store.get_item(block_key))
+        except Exception as e:
+            logger.error("XblockCompletion - Error to read problem block, block id: {}, error: {}".format(str(block_key), str(e)))
+            continue
+        update_block_answers(view, course_key, block_item, student_states)
+
+class AnswersBatch(object):
+    """
+    StudentModule ids saved in a transaction, sent in one update task when it is committed
+    """
+    def __init__(self):
+        self.ids = set()
+        self.sent = False
+
+    def __call__(self):
+        self.sent = True
+        student_module_ids = sorted(self.ids)
+        chunk_size = getattr(settings, 'XBLOCKCOMPLETION_CHUNK_SIZE', 2000)
+        for i in range(0, len(student_module_ids), chunk_size):
+            update_materialized_answers.delay(student_module_ids[i:i + chunk_size])
+
+@receiver(post_save, sender=StudentModule)
+def queue_answers_update(sender, instance, **kwargs):
+    """
+    Queue the update of the materialized rows of a problem state, the states saved
+    in a transaction are sent in one batch when it is committed
+    """
+    if not getattr(settings, 'XBLOCKCOMPLETION_MATERIALIZED_ANSWERS', False) or instance.module_type != 'problem':
+        return
+    # the thread keeps a weak reference to the batch registered in on_commit, a rollback
+    # discards the callback and with it the batch, so the next save registers a new one
+    batch = _pending.batch() if getattr(_pending, 'batch', None) is not None else None
+    if batch is not None and not batch.sent:
+        batch.ids.add(instance.id)
+        return
+    batch = AnswersBatch()
+    batch.ids.add(instance.id)
+    _pending.batch = weakref.ref(batch)
+    # outside a transaction the batch is sent now
+    transaction.on_commit(batch)
+
+@receiver(post_delete, sender=StudentModule)
+def delete_answers(sender, instance, **kwargs):
+    """
+    Delete the materialized rows of a deleted problem state
+    """
+    if not getattr(settings, 'XBLOCKCOMPLETION_MATERIALIZED_ANSWERS', False) or instance.module_type != 'problem':
+        return
+    XblockCompletionAnswer.objects.filter(
+        course_id=instance.course_id,
+        block_id=instance.module_state_key,
+        student_id=instance.student_id).delete()
@@ -25,3 +25,7 @@ class XblockCompletionConfig(AppConfig):
                     PluginSettings.RELATIVE_PATH: "settings.common"}},
         },
     }
+
+    def ready(self):
+        # connect the receivers of the materialized answers
+        from . import answers  # pylint: disable=unused-import
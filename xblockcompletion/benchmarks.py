@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the report generation on synthetic courses.
+
+Run it in the same environment as the tests:
+    XBLOCKCOMPLETION_BENCHMARK=1 DJANGO_SETTINGS_MODULE=lms.envs.test pytest xblockcompletion/benchmarks.py
+
+The size of the course is configured with the environment variables
+XBLOCKCOMPLETION_BENCHMARK_PROBLEMS, XBLOCKCOMPLETION_BENCHMARK_STUDENTS,
+XBLOCKCOMPLETION_BENCHMARK_ANSWERS (questions by problem),
+XBLOCKCOMPLETION_BENCHMARK_RANDOMIZED and XBLOCKCOMPLETION_BENCHMARK_MALFORMED
+(share of randomized and malformed problems, 0 to 1). The results are saved as
+json in XBLOCKCOMPLETION_BENCHMARK_OUTPUT.
+"""
+# Python Standard Libraries
+import json
+import os
+import random
+import tracemalloc
+import unittest
+from time import time
+
+# Installed packages (via pip)
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mock import patch
+
+# Edx dependencies
+from capa.tests.response_xml_factory import MultipleChoiceResponseXMLFactory
+from common.djangoapps.student.models import CourseEnrollment
+from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
+from xmodule.modulestore.tests.django_utils import ModuleStoreTestCase
+from xmodule.modulestore.tests.factories import CourseFactory, ItemFactory
+from lms.djangoapps.courseware.models import StudentModule
+
+# Internal project dependencies
+from .views import doc_id_cache, generate
+
+BENCHMARK_ENABLED = os.environ.get('XBLOCKCOMPLETION_BENCHMARK', '') != ''
+MALFORMED_PROBLEM_XML = '<problem><multiplechoiceresponse><choicegroup type="MultipleChoice"></problem>'
+MODULESTORE_METHODS = ('get_item', 'get_items', 'get_course')
+
+
+def _get_config():
+    return {
+        'problems': int(os.environ.get('XBLOCKCOMPLETION_BENCHMARK_PROBLEMS', 50)),
+        'students': int(os.environ.get('XBLOCKCOMPLETION_BENCHMARK_STUDENTS', 200)),
+        'answers': int(os.environ.get('XBLOCKCOMPLETION_BENCHMARK_ANSWERS', 2)),
+        'randomized': float(os.environ.get('XBLOCKCOMPLETION_BENCHMARK_RANDOMIZED', 0.2)),
+        'malformed': float(os.environ.get('XBLOCKCOMPLETION_BENCHMARK_MALFORMED', 0.05)),
+    }
+
+
+@unittest.skipUnless(BENCHMARK_ENABLED, 'Set XBLOCKCOMPLETION_BENCHMARK to run the benchmark')
+class BenchmarkXblockCompletionReport(ModuleStoreTestCase):
+    def setUp(self):
+        super(BenchmarkXblockCompletionReport, self).setUp()
+        doc_id_cache.clear()
+        # same course for each run of the benchmark
+        random.seed(0)
+        self.config = _get_config()
+        self.course = CourseFactory.create(org='bench', course='999', display_name='bench')
+        CourseOverview.get_from_id(self.course.id)
+        self.problems = self._create_problems()
+        self.students = self._create_students()
+        self._create_student_modules()
+
+    def _create_problems(self):
+        """
+            Create the problems of the course, 10 problems by unit
+        """
+        problem_xml = MultipleChoiceResponseXMLFactory().build_xml(
+            question_text='The correct answer is Choice 2',
+            choices=[False, True, False, False],
+            num_responses=self.config['answers'])
+        problems = []
+        with self.store.bulk_operations(self.course.id, emit_signals=False):
+            chapter = ItemFactory.create(parent_location=self.course.location, category='chapter')
+            sequential = ItemFactory.create(parent_location=chapter.location, category='sequential')
+            for i in range(self.config['problems']):
+                if i % 10 == 0:
+                    vertical = ItemFactory.create(parent_location=sequential.location, category='vertical')
+                randomized = random.random() < self.config['randomized']
+                malformed = random.random() < self.config['malformed']
+                problem = ItemFactory.create(
+                    parent_location=vertical.location,
+                    category='problem',
+                    data=MALFORMED_PROBLEM_XML if malformed else problem_xml,
+                    metadata={'rerandomize': 'always' if randomized else 'never'},
+                    weight=1)
+                problems.append((problem, randomized))
+        return problems
+
+    def _create_students(self):
+        User.objects.bulk_create([
+            User(username='bench_student_{}'.format(i), email='bench_student_{}@edx.org'.format(i))
+            for i in range(self.config['students'])
+        ])
+        students = list(User.objects.filter(username__startswith='bench_student_'))
+        CourseEnrollment.objects.bulk_create([
+            CourseEnrollment(user=student, course_id=self.course.id, mode='honor', is_active=True)
+            for student in students
+        ])
+        return students
+
+    def _create_student_modules(self):
+        for problem, randomized in self.problems:
+            answer_ids = [
+                '{}_{}_1'.format(problem.location.html_id(), i + 2)
+                for i in range(self.config['answers'])
+            ]
+            student_modules = []
+            for student in self.students:
+                answers = {answer_id: 'choice_{}'.format(random.randint(0, 3)) for answer_id in answer_ids}
+                state = {
+                    'attempts': random.randint(1, 3),
+                    'seed': random.randint(1, 20) if randomized else 1,
+                    'score': {
+                        'raw_earned': sum(1 for x in answers.values() if x == 'choice_1'),
+                        'raw_possible': len(answer_ids)
+                    },
+                    'student_answers': answers,
+                    'correct_map': {
+                        answer_id: {'correctness': 'correct' if answer == 'choice_1' else 'incorrect'}
+                        for answer_id, answer in answers.items()
+                    },
+                }
+                # the grade columns are saved by capa with the state, the resumen report reads them
+                student_modules.append(StudentModule(
+                    module_state_key=problem.location,
+                    student=student,
+                    course_id=self.course.id,
+                    module_type='problem',
+                    grade=state['score']['raw_earned'],
+                    max_grade=state['score']['raw_possible'],
+                    state=json.dumps(state)))
+            StudentModule.objects.bulk_create(student_modules)
+
+    def _run_report(self, is_resumen):
+        """
+            Generate the report and return its measures
+        """
+        data = {'format': is_resumen, 'course': str(self.course.id), 'base_url': 'this_is_a_url'}
+        task_input = {'data': data}
+        modulestore_calls = {}
+        patches = [patch('xblockcompletion.views.get_user_id_doc_id_pairs', return_value=[])]
+        for method in MODULESTORE_METHODS:
+            patches.append(patch.object(
+                type(self.store), method, autospec=True, side_effect=getattr(type(self.store), method)))
+        mocks = [x.start() for x in patches]
+        tracemalloc.start()
+        start = time()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                    result = generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+            wall_time = time() - start
+            peak_memory = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            for x in patches:
+                x.stop()
+        for method, mock in zip(MODULESTORE_METHODS, mocks[1:]):
+            modulestore_calls[method] = mock.call_count
+        return {
+            'format': 'resumen' if is_resumen else 'all',
+            'config': self.config,
+            'wall_time': round(wall_time, 3),
+            'rows': result['rows_written'],
+            'rows_per_sec': round(result['rows_written'] / wall_time, 1) if wall_time else None,
+            'queries': len(queries.captured_queries),
+            'peak_memory_bytes': peak_memory,
+            'modulestore_calls': modulestore_calls,
+            'timing': result['timing'],
+        }
+
+    def test_benchmark_report(self):
+        results = [self._run_report(True), self._run_report(False)]
+        output = os.environ.get('XBLOCKCOMPLETION_BENCHMARK_OUTPUT', 'xblockcompletion_benchmark.json')
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+        for result in results:
+            self.assertGreater(result['rows'], 0)
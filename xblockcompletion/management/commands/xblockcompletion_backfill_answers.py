@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+# Python Standard Libraries
+import logging
+
+# Installed packages (via pip)
+from django.core.management.base import BaseCommand, CommandError
+
+# Edx dependencies
+from opaque_keys import InvalidKeyError
+from opaque_keys.edx.keys import CourseKey
+
+# Internal project dependencies
+from xblockcompletion.answers import backfill_course_answers
+from xblockcompletion.views import XblockCompletionView
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Build the materialized answers (XblockCompletionAnswer) of all the students of the courses'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_ids', nargs='+', help='course ids')
+        parser.add_argument('--since', default='', help='only the states modified since this date (YYYY-MM-DD or ISO datetime, UTC)')
+
+    def handle(self, *args, **options):
+        try:
+            course_keys = [CourseKey.from_string(x) for x in options['course_ids']]
+            modified_since = XblockCompletionView().validate_since(options['since']) if options['since'] else None
+        except (InvalidKeyError, ValueError) as e:
+            raise CommandError(str(e))
+        for course_key in course_keys:
+            rows = backfill_course_answers(course_key, modified_since)
+            logger.info("XblockCompletion - Answers backfilled, course: {}, rows: {}".format(course_key, rows))
+            self.stdout.write('{}: {} rows'.format(course_key, rows))
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+# Python Standard Libraries
+import logging
+from collections import OrderedDict
+
+# Installed packages (via pip)
+from django.core.management.base import BaseCommand, CommandError
+import six
+
+# Edx dependencies
+from opaque_keys import InvalidKeyError
+from opaque_keys.edx.keys import CourseKey
+from xmodule.modulestore.django import modulestore
+
+# Internal project dependencies
+from xblockcompletion.views import XblockCompletionView
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Compare the report rows of the materialized answers with the rows built from the student states'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_ids', nargs='+', help='course ids')
+
+    def handle(self, *args, **options):
+        try:
+            course_keys = [CourseKey.from_string(x) for x in options['course_ids']]
+        except InvalidKeyError as e:
+            raise CommandError(str(e))
+        inconsistent = 0
+        for course_key in course_keys:
+            for block_key, is_resumen in self.get_inconsistent_blocks(course_key):
+                inconsistent += 1
+                logger.error("XblockCompletion - Inconsistent materialized answers, course: {}, block id: {}, format: {}".format(
+                    course_key, block_key, 'resumen' if is_resumen else 'all'))
+                self.stdout.write('{} {} {}'.format(course_key, block_key, 'resumen' if is_resumen else 'all'))
+        if inconsistent:
+            raise CommandError('{} inconsistent blocks, run xblockcompletion_backfill_answers to rebuild them'.format(inconsistent))
+        self.stdout.write('OK')
+
+    def get_inconsistent_blocks(self, course_key):
+        """
+            Yield (block_key, is_resumen) of the blocks whose materialized rows differ from
+            the rows generated from the StudentModule states
+        """
+        view = XblockCompletionView()
+        store = modulestore()
+        with store.bulk_operations(course_key):
+            outline = view.get_course_outline(course_key, store)
+            blocks = view.get_report_blocks(course_key, store, outline)
+            for block_key, block_item in blocks.items():
+                block_outline = OrderedDict([(block_key, outline[block_key])])
+                for is_resumen in (True, False):
+                    live_rows = [
+                        row
+                        for __, student_states in view.get_course_user_states(course_key, [block_key], is_resumen=is_resumen)
+                        for row in view.get_block_rows(block_key, block_item, outline[block_key], student_states, is_resumen)
+                    ]
+                    materialized_rows = list(view.get_materialized_rows(course_key, block_outline, blocks, is_resumen))
+                    if self.normalize(live_rows) != self.normalize(materialized_rows):
+                        yield block_key, is_resumen
+
+    def normalize(self, rows):
+        # the rows are compared as they are written in the csv
+        return [[six.text_type(x) if x is not None else '' for x in row] for row in rows]
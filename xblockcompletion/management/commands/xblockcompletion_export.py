@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -- coding: utf-8 --
+# Python Standard Libraries
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from time import time
+
+# Installed packages (via pip)
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from pytz import UTC
+
+# Edx dependencies
+from lms.djangoapps.instructor_task.models import ReportStore
+from opaque_keys import InvalidKeyError
+from opaque_keys.edx.keys import CourseKey
+from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
+
+# Internal project dependencies
+from xblockcompletion.models import XblockCompletionReport
+from xblockcompletion.views import (
+    ReportStats,
+    XblockCompletionView,
+    _get_output_buffer,
+    _get_report_name,
+    _get_report_writer,
+    _store_report,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Generate the question reports of many courses with a pool of workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_ids', nargs='*', help='course ids')
+        parser.add_argument('--org', action='append', default=[], help='include the courses of the organization, repeatable')
+        parser.add_argument('--format', choices=['resumen', 'all', 'both'], default='both')
+        parser.add_argument('--output', choices=['csv', 'csv.gz', 'parquet', 'xlsx'], default='csv')
+        parser.add_argument('--workers', type=int, default=1, help='courses generated at the same time')
+        parser.add_argument('--state-file', default='', help='json file with the reports already generated, '
+                            'the reports in it are skipped so a failed export can be resumed')
+
+    def handle(self, *args, **options):
+        try:
+            course_keys = [CourseKey.from_string(x) for x in options['course_ids']]
+        except InvalidKeyError as e:
+            raise CommandError(str(e))
+        if options['org']:
+            course_keys += list(CourseOverview.objects.filter(org__in=options['org']).order_by('id').values_list('id', flat=True))
+        if not course_keys:
+            raise CommandError('No courses, give course ids or --org')
+        formats = {'resumen': [True], 'all': [False], 'both': [True, False]}[options['format']]
+        self.output = options['output']
+        self.state_file = options['state_file']
+        self.state = self.load_state()
+        self.lock = threading.Lock()
+        # each worker reuses its view, with its compiled problems, between courses
+        self.local = threading.local()
+        jobs = [
+            (course_key, is_resumen)
+            for course_key in course_keys
+            for is_resumen in formats
+            if self.get_job_id(course_key, is_resumen) not in self.state['done']
+        ]
+        logger.info("XblockCompletion - Export started, reports: {}, skipped: {}".format(
+            len(jobs), len(course_keys) * len(formats) - len(jobs)))
+        if options['workers'] > 1:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                results = list(executor.map(lambda job: self.export_report(*job), jobs))
+        else:
+            results = [self.export_report(*job) for job in jobs]
+        failed = [x for x in results if 'error' in x]
+        for result in results:
+            self.stdout.write(json.dumps(result, sort_keys=True))
+        if failed:
+            raise CommandError('{} of {} reports failed, run the command again with the same --state-file to resume'.format(len(failed), len(results)))
+
+    def export_report(self, course_key, is_resumen):
+        """
+            Generate and store the report of a course, return its summary
+        """
+        view = getattr(self.local, 'view', None)
+        if view is None:
+            view = self.local.view = XblockCompletionView()
+        view.stats = ReportStats()
+        view.enrolled_student_ids = None
+        # the doc_ids of the students of other courses are not kept, the shared DocIdCache still has them
+        view.doc_ids = {}
+        summary = {'course': str(course_key), 'format': 'resumen' if is_resumen else 'all'}
+        start_time = time()
+        # the connections of the worker that failed or are older than CONN_MAX_AGE are closed between courses
+        close_old_connections()
+        try:
+            data = {'format': is_resumen, 'course': str(course_key), 'base_url': '', 'scope': {}, 'output': self.output}
+            report_store = ReportStore.from_config('GRADES_DOWNLOAD')
+            report_name = _get_report_name(course_key, data, datetime.now(UTC))
+            fingerprint = view.get_report_fingerprint(data)
+            output_buffer = _get_output_buffer()
+            report_writer = _get_report_writer(self.output, output_buffer)
+            view._build_student_data(data, report_writer)
+            report_writer.close()
+            view.stats.log_failed_blocks(course_key)
+            with view.stats.timer('upload'):
+                _store_report(report_store, course_key, report_name, output_buffer)
+            output_buffer.close()
+            XblockCompletionReport.objects.create(course_id=course_key, fingerprint=fingerprint, report_name=report_name)
+            summary.update(
+                report_name=report_name, rows=view.stats.rows, failed_blocks=len(view.stats.failed_blocks), timing=view.stats.get_timing())
+            self.save_state(course_key, is_resumen, report_name)
+        except Exception as e:
+            logger.exception("XblockCompletion - Error to export report, course: {}, format: {}".format(course_key, summary['format']))
+            summary['error'] = str(e)
+        summary['seconds'] = round(time() - start_time, 3)
+        return summary
+
+    def get_job_id(self, course_key, is_resumen):
+        return '{}|{}'.format(course_key, 'resumen' if is_resumen else 'all')
+
+    def load_state(self):
+        if self.state_file and os.path.exists(self.state_file):
+            with open(self.state_file) as state_file:
+                return json.load(state_file)
+        return {'done': {}}
+
+    def save_state(self, course_key, is_resumen, report_name):
+        with self.lock:
+            self.state['done'][self.get_job_id(course_key, is_resumen)] = report_name
+            if self.state_file:
+                with open(self.state_file, 'w') as state_file:
+                    json.dump(self.state, state_file, indent=2, sort_keys=True)
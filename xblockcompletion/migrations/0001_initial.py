@@ -0,0 +1,29 @@
+from django.db import migrations, models
+import opaque_keys.edx.django.models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XblockCompletionBlockReport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('course_id', opaque_keys.edx.django.models.CourseKeyField(db_index=True, max_length=255)),
+                ('block_id', opaque_keys.edx.django.models.UsageKeyField(max_length=255)),
+                ('report_format', models.CharField(max_length=20)),
+                ('watermark', models.DateTimeField(null=True)),
+                ('content_version', models.CharField(default='', max_length=255)),
+                ('rows', models.TextField(default='{}')),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'unique_together': {('course_id', 'block_id', 'report_format')},
+            },
+        ),
+    ]
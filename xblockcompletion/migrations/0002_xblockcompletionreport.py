@@ -0,0 +1,22 @@
+from django.db import migrations, models
+import opaque_keys.edx.django.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xblockcompletion', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XblockCompletionReport',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('course_id', opaque_keys.edx.django.models.CourseKeyField(db_index=True, max_length=255)),
+                ('fingerprint', models.CharField(db_index=True, max_length=64)),
+                ('report_name', models.CharField(max_length=255)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import opaque_keys.edx.django.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('xblockcompletion', '0002_xblockcompletionreport'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XblockCompletionAnswer',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('course_id', opaque_keys.edx.django.models.CourseKeyField(db_index=True, max_length=255)),
+                ('block_id', opaque_keys.edx.django.models.UsageKeyField(max_length=255)),
+                ('report_format', models.CharField(max_length=20)),
+                ('position', models.PositiveSmallIntegerField(default=0)),
+                ('answer_id', models.CharField(default='', max_length=255)),
+                ('question', models.TextField(default='')),
+                ('answer', models.TextField(default='')),
+                ('correct_answer', models.TextField(default='')),
+                ('attempts', models.IntegerField(null=True)),
+                ('gained', models.FloatField()),
+                ('possible', models.FloatField(null=True)),
+                ('total', models.FloatField()),
+                ('has_saved_answers', models.BooleanField(default=False)),
+                ('state', models.TextField(null=True)),
+                ('modified', models.DateTimeField()),
+                ('student', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('course_id', 'block_id', 'report_format', 'student', 'position')},
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+import opaque_keys.edx.django.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('xblockcompletion', '0003_xblockcompletionanswer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='XblockCompletionCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('checkpoint_id', models.CharField(max_length=255, unique=True)),
+                ('course_id', opaque_keys.edx.django.models.CourseKeyField(db_index=True, max_length=255)),
+                ('content_version', models.CharField(default='', max_length=255)),
+                ('fingerprint', models.CharField(default='', max_length=64)),
+                ('parts', models.TextField(default='[]')),
+                ('doc_ids', models.TextField(default='{}')),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
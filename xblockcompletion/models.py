@@ -1,4 +1,97 @@
+from django.conf import settings
 from django.db import models
+from opaque_keys.edx.django.models import CourseKeyField, UsageKeyField
 # Create your models here.
 
 
+class XblockCompletionBlockReport(models.Model):
+    """
+        Rows of a problem block in a report, saved to generate incremental reports.
+        rows is a json dict, student id -> list of report rows of the student
+    """
+    class Meta:
+        unique_together = ('course_id', 'block_id', 'report_format')
+
+    course_id = CourseKeyField(max_length=255, db_index=True)
+    block_id = UsageKeyField(max_length=255)
+    # 'resumen' or 'all'
+    report_format = models.CharField(max_length=20)
+    # max StudentModule.modified processed
+    watermark = models.DateTimeField(null=True)
+    # version of the course content used to generate the rows
+    content_version = models.CharField(max_length=255, default='')
+    rows = models.TextField(default='{}')
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{} - {}'.format(self.block_id, self.report_format)
+
+
+class XblockCompletionReport(models.Model):
+    """
+        Report generated by a task, a request with the same fingerprint
+        (course, format, scope, student states and course content) reuses it
+    """
+    course_id = CourseKeyField(max_length=255, db_index=True)
+    fingerprint = models.CharField(max_length=64, db_index=True)
+    report_name = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{} - {}'.format(self.course_id, self.report_name)
+
+
+class XblockCompletionAnswer(models.Model):
+    """
+        Materialized report rows of a student in a problem block, maintained from the
+        StudentModule changes. report_format 'resumen' has one row per block (answer_id ''),
+        'all' one row per answer (answer_id '' if the capa problem could not be read)
+    """
+    class Meta:
+        unique_together = ('course_id', 'block_id', 'report_format', 'student', 'position')
+
+    course_id = CourseKeyField(max_length=255, db_index=True)
+    block_id = UsageKeyField(max_length=255)
+    student = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_constraint=False)
+    # 'resumen' or 'all'
+    report_format = models.CharField(max_length=20)
+    # order of the answer in the student state
+    position = models.PositiveSmallIntegerField(default=0)
+    answer_id = models.CharField(max_length=255, default='')
+    question = models.TextField(default='')
+    answer = models.TextField(default='')
+    correct_answer = models.TextField(default='')
+    attempts = models.IntegerField(null=True)
+    gained = models.FloatField()
+    possible = models.FloatField(null=True)
+    total = models.FloatField()
+    has_saved_answers = models.BooleanField(default=False)
+    # raw state of the rows of a problem that could not be read
+    state = models.TextField(null=True)
+    # StudentModule.modified of the state of the row
+    modified = models.DateTimeField()
+
+    def __str__(self):
+        return '{} - {} - {}'.format(self.block_id, self.student_id, self.answer_id)
+
+
+class XblockCompletionCheckpoint(models.Model):
+    """
+        Progress of a report task, the csv parts already generated with their blocks
+        and the identity map, used to resume the task after a worker restart
+    """
+    # task type and task key of the report
+    checkpoint_id = models.CharField(max_length=255, unique=True)
+    course_id = CourseKeyField(max_length=255, db_index=True)
+    # version of the course content of the parts
+    content_version = models.CharField(max_length=255, default='')
+    # fingerprint of the report when the first part was generated
+    fingerprint = models.CharField(max_length=64, default='')
+    # json list of {'key', 'blocks', 'path', 'failed_blocks'} in report order
+    parts = models.TextField(default='[]')
+    # json dict, user id -> doc_id
+    doc_ids = models.TextField(default='{}')
+    modified = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.checkpoint_id
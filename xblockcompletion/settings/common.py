@@ -1,2 +1,50 @@
-def plugin_settings(settings):
-    settings.XBLOCKCOMPLETION_LIMIT_STUDENTS = 1000
\ No newline at end of file
+def plugin_settings(settings):
+    settings.XBLOCKCOMPLETION_LIMIT_STUDENTS = 1000
+    # database alias of the report read queries (StudentModule, enrollments, answers, CourseOverview)
+    settings.XBLOCKCOMPLETION_READ_DB = 'default'
+    # seconds the read database can be behind the default database before the reports fall back to it
+    settings.XBLOCKCOMPLETION_READ_DB_MAX_LAG = 60
+    settings.XBLOCKCOMPLETION_CHUNK_SIZE = 2000
+    settings.XBLOCKCOMPLETION_BLOCKS_CHUNK_SIZE = 100
+    settings.XBLOCKCOMPLETION_COMPILED_PROBLEMS_SIZE = 32
+    # bytes of the report kept in memory before spooling it to disk
+    settings.XBLOCKCOMPLETION_SPOOL_MAX_SIZE = 5 * 1024 * 1024
+    # doc_id cache shared between report tasks, set TTL to 0 to disable it
+    settings.XBLOCKCOMPLETION_DOC_ID_CACHE_TTL = 600
+    settings.XBLOCKCOMPLETION_DOC_ID_CACHE_SIZE = 50000
+    # workers used to build the rows of the blocks in parallel, 0 to disable it
+    settings.XBLOCKCOMPLETION_PARALLEL_WORKERS = 0
+    # 'thread' or 'process'
+    settings.XBLOCKCOMPLETION_PARALLEL_BACKEND = 'thread'
+    # problems per shard of a report generated by subtasks, 0 to disable it
+    settings.XBLOCKCOMPLETION_SHARD_BLOCKS = 0
+    # a worker must consume it, the reports are not sharded if it is the queue of the report task
+    settings.XBLOCKCOMPLETION_SHARD_QUEUE = 'edx.lms.core.xblockcompletion_shards'
+    settings.XBLOCKCOMPLETION_SHARD_POLL_INTERVAL = 5
+    # reuse the rows saved by previous reports and only process the modified student states
+    settings.XBLOCKCOMPLETION_INCREMENTAL = False
+    # seconds before the watermark of the incremental report read again, for the transactions committed late
+    settings.XBLOCKCOMPLETION_INCREMENTAL_OVERLAP = 300
+    # seconds between the progress updates of a report task
+    settings.XBLOCKCOMPLETION_PROGRESS_INTERVAL = 5
+    # extract the fields of the resumen report with MySQL json functions (MySQL 5.7+)
+    settings.XBLOCKCOMPLETION_RESUMEN_DB_EXTRACT = False
+    # enrollment modes of the students included in the reports
+    settings.XBLOCKCOMPLETION_ENROLLMENT_MODES = ['honor']
+    # max number of student ids sent in a StudentModule query
+    settings.XBLOCKCOMPLETION_STUDENTS_CHUNK_SIZE = 5000
+    # return the last report when nothing changed since it was generated
+    settings.XBLOCKCOMPLETION_REUSE_REPORTS = True
+    # keep the report rows in XblockCompletionAnswer from the StudentModule changes and read the reports from it,
+    # fill the table with the xblockcompletion_backfill_answers command before enabling it
+    settings.XBLOCKCOMPLETION_MATERIALIZED_ANSWERS = False
+    # blocks read from the database ahead of the thread that builds the rows, 0 to build them in the same thread
+    settings.XBLOCKCOMPLETION_PIPELINE_QUEUE_SIZE = 4
+    # answer texts counted by question in the distribution report, the others are counted together
+    settings.XBLOCKCOMPLETION_DISTRIBUTION_MAX_ANSWERS = 100
+    # buckets of the histogram of the block scores in the distribution report
+    settings.XBLOCKCOMPLETION_DISTRIBUTION_BUCKETS = 10
+    # blocks generated between the checkpoints of a report task, 0 to disable them
+    settings.XBLOCKCOMPLETION_CHECKPOINT_BLOCKS = 100
+    # seconds a checkpoint is kept without changes, 0 to disable the checkpoints (also of sharded reports)
+    settings.XBLOCKCOMPLETION_CHECKPOINT_TTL = 24 * 60 * 60
@@ -1,12 +1,24 @@
+function download_report_xblockcompletion(data, xhr){
+  var disposition = xhr.getResponseHeader('Content-Disposition') || '';
+  var match = disposition.match(/filename="([^"]+)"/);
+  var link = document.createElement('a');
+  link.href = window.URL.createObjectURL(new Blob([data], {type: 'text/csv;charset=utf-8'}));
+  link.download = match ? match[1] : 'Reporte_de_Preguntas.csv';
+  document.body.appendChild(link);
+  link.click();
+  document.body.removeChild(link);
+  window.URL.revokeObjectURL(link.href);
+}
+
 function generate_report_xblockcompletion(input){
   var success_div = document.getElementById('xblockcompletion-success-msg');
   var error_div = document.getElementById('xblockcompletion-error-msg');
   var warning_div = document.getElementById('xblockcompletion-warning-msg');
   var url = input.dataset.endpoint;
   var errorMessage = 'Error en generar reporte de problemas. Por favor actualice la página e intente de nuevo.';
+  // small courses return the csv report, the others the status of the report task
   return $.ajax({
       type: 'GET',
-      dataType: 'json',
       url: url,
       error: function(error) {
           if (error.responseText) {
@@ -18,8 +30,23 @@ function generate_report_xblockcompletion(input){
           warning_div.style.display = 'none';
           return true
       },
-      success: function(data) {
-          if (data.error) {
+      success: function(data, textStatus, xhr) {
+          if ((xhr.getResponseHeader('Content-Type') || '').indexOf('text/csv') === 0) {
+              // a report that failed while it was streamed ends with the error marker or in the middle of a row
+              if (data.slice(-2) !== '\r\n' || data.indexOf('"#XBLOCKCOMPLETION_ERROR"') !== -1) {
+                  error_div.textContent = errorMessage;
+                  error_div.style.display = 'block';
+                  success_div.style.display = 'none';
+                  warning_div.style.display = 'none';
+                  return true
+              }
+              download_report_xblockcompletion(data, xhr);
+              success_div.textContent = 'El reporte de preguntas fue descargado.';
+              success_div.style.display = 'block';
+              warning_div.style.display = 'none';
+              error_div.style.display = 'none';
+          }
+          else if (data.error) {
               error_div.textContent = errorMessage;
               error_div.style.display = 'block';
               success_div.style.display = 'none';
@@ -4,8 +4,10 @@
 import json
 
 # Installed packages (via pip)
+from django.conf import settings
+from django.db import DatabaseError
 from django.urls import reverse
-from django.test import Client
+from django.test import Client, override_settings
 from mock import patch
 
 # Edx dependencies
@@ -18,11 +20,13 @@ from lms.djangoapps.courseware.models import StudentModule
 from lms.djangoapps.instructor_task.models import ReportStore
 
 # Internal project dependencies
-from .views import generate
+from .models import XblockCompletionBlockReport, XblockCompletionCheckpoint, XblockCompletionReport
+from .views import AnswerDistribution, doc_id_cache, generate, ReportBlock, task_process_data, XblockCompletionView
 
 class TestXblockCompletionView(ModuleStoreTestCase):
     def setUp(self):
         super(TestXblockCompletionView, self).setUp()
+        doc_id_cache.clear()
         self.course = CourseFactory.create(
             org='mss',
             course='999',
@@ -116,6 +120,21 @@ class TestXblockCompletionView(ModuleStoreTestCase):
                 self.assertNotIn(data, csv_file_data)
 
 
+    def _create_multiple_choice_problem(self):
+        """
+            Create a multiple choice problem in the unit
+        """
+        from capa.tests.response_xml_factory import MultipleChoiceResponseXMLFactory
+        problem_xml = MultipleChoiceResponseXMLFactory().build_xml(
+            question_text='The correct answer is Choice 2',
+            choices=[False, True, False])
+        with self.store.bulk_operations(self.course.id, emit_signals=False):
+            return ItemFactory.create(
+                parent_location=self.subsection.location,
+                category="problem",
+                data=problem_xml,
+                weight=2)
+
     def test_xblockcompletion_get(self):
         """
             Test xblockcompletion view
@@ -137,6 +156,8 @@ class TestXblockCompletionView(ModuleStoreTestCase):
             student=self.student,
             course_id=self.course.id,
             module_type='problem',
+            grade=1,
+            max_grade=3,
             state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts":1,"has_saved_answers": true, "correct_map": {"id_question_2_1": {"correctness": "correct"},"id_question_3_1": {"correctness": "incorrect"}, "id_question_4_1": {"correctness": "incorrect"} } }')
         module.save()
         module2 = StudentModule(
@@ -146,11 +167,14 @@ class TestXblockCompletionView(ModuleStoreTestCase):
             module_type='problem',
             state='{"score": {"raw_earned": 0, "raw_possible": 3}, "seed": 1, "correct_map": {"id_question_2_1": {"correctness": "incorrect"},"id_question_3_1": {"correctness": "incorrect"}, "id_question_4_1": {"correctness": "incorrect"} } }')
         module2.save()
-        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
-            result = generate(
-                None, None, self.course.id,
-                task_input, 'EOL_Xblock_Completion'
-            )
+        with patch('xblockcompletion.views.json.loads', wraps=json.loads) as loads:
+            with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                result = generate(
+                    None, None, self.course.id,
+                    task_input, 'EOL_Xblock_Completion'
+                )
+        # the score is read from the grade columns, the state is not parsed
+        self.assertNotIn(module.state, [x[0][0] for x in loads.call_args_list])
         report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
         header_row = ";".join(['"Username"', '"Email"', '"Run"', '"Seccion"', '"SubSeccion"', '"Unidad"', '"Titulo"', '"Intentos"', '"Pts Ganados"', '"Pts Posibles"', '"block id"', '"Has saved answers"'])
         student1_row = ";".join([
@@ -323,6 +347,7 @@ class TestXblockCompletionView(ModuleStoreTestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(json.loads(response._container[0].decode()), {'error': 'Usuario no tiene rol para esta funcionalidad'})
 
+    @override_settings(XBLOCKCOMPLETION_LIMIT_STUDENTS=0)
     def test_xblockcompletion_get_data_researcher(self):
         """
             Test xblockcompletion view when user is data researcher
@@ -336,3 +361,1205 @@ class TestXblockCompletionView(ModuleStoreTestCase):
         r = json.loads(response._container[0].decode())
         self.assertEqual(response.status_code, 200)
         self.assertEqual(r['status'], 'El reporte de preguntas esta siendo creado, en un momento estará disponible para descargar.')
+
+    def test_xblockcompletion_get_streaming(self):
+        """
+            Test the report of a course with less than XBLOCKCOMPLETION_LIMIT_STUDENTS students is returned in the request
+        """
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        data = {
+            'format':'resumen',
+            'course':  str(self.course.id)
+        }
+        with patch('xblockcompletion.views.submit_task') as submit:
+            response = self.client_instructor.get(reverse('xblockcompletion-data:data'), data)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(submit.called)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('Reporte_de_Preguntas_Resumen', response['Content-Disposition'])
+        content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(content.startswith('"Username";"Email"'))
+        self.assertIn('"{}";"{}";"";'.format(self.student.username, self.student.email), content)
+        self.assertIn('"1";"3.0";"9.0";"{}"'.format(str(self.items[0].location)), content)
+
+    def test_xblockcompletion_get_streaming_error(self):
+        """
+            Test the streaming report ends with the error marker when a row fails after the header is sent
+        """
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        data = {
+            'format':'resumen',
+            'course':  str(self.course.id)
+        }
+        with patch('xblockcompletion.views.XblockCompletionView.get_course_rows', side_effect=Exception('error')):
+            response = self.client_instructor.get(reverse('xblockcompletion-data:data'), data)
+            content = b''.join(response.streaming_content).decode('utf-8')
+        self.assertTrue(content.startswith('"Username";"Email"'))
+        self.assertTrue(content.endswith('"#XBLOCKCOMPLETION_ERROR"\r\n'))
+
+    def test_xblockcompletion_get_wrong_scope(self):
+        """
+            Test xblockcompletion view with wrong filters
+        """
+        other_course = CourseFactory.create(org='mss', course='222', display_name='other')
+        wrong_params = [
+            {'section': 'this_is_not_a_block_id'},
+            {'section': str(self.section.location)},
+            {'block': str(other_course.id.make_usage_key('problem', 'other'))},
+            {'cohort': 'one'},
+            {'cohort': '999'},
+            {'since': '2021-13-45'},
+        ]
+        for params in wrong_params:
+            data = dict(params, format='resumen', course=str(self.course.id))
+            response = self.client_instructor.get(reverse('xblockcompletion-data:data'), data)
+            self.assertEqual(json.loads(response._container[0].decode()), {'error': 'Parametros de filtro incorrectos'})
+
+    def test_xblockcompletion_scope(self):
+        """
+            Test validate_and_get_scope and the task key of scoped reports
+        """
+        from django.test import RequestFactory
+        request = RequestFactory().get('/', {
+            'subsection': str(self.section.location),
+            'block': [str(self.items[0].location), str(self.items[1].location)],
+            'user': ['student'],
+            'since': '2021-03-01',
+        })
+        scope = XblockCompletionView().validate_and_get_scope(request, self.course.id)
+        self.assertEqual(scope, {
+            'subsection': str(self.section.location),
+            'blocks': [str(self.items[0].location), str(self.items[1].location)],
+            'users': ['student'],
+            'since': '2021-03-01T00:00:00+00:00',
+        })
+        task_keys = []
+        with patch('xblockcompletion.views.submit_task') as submit:
+            for scope in [{}, {'users': ['student']}, {'users': ['other']}]:
+                task_process_data(None, {'format': True, 'course': str(self.course.id), 'scope': scope})
+                task_keys.append(submit.call_args[0][5])
+        self.assertEqual(task_keys[0], 'EOL_Xblock_Completion_{}'.format(str(self.course.id)))
+        self.assertEqual(len(set(task_keys)), 3)
+
+    def test_xblockcompletion_scoped_report(self):
+        """
+            Test the report only includes the blocks and students of the scope
+        """
+        with patch('common.djangoapps.student.models.cc.User.save'):
+            student2 = UserFactory(username='student2', password='test', email='student2@edx.org')
+            CourseEnrollmentFactory(user=student2, course_id=self.course.id, mode='honor')
+        for student in [self.student, student2]:
+            for item in self.items:
+                StudentModule.objects.create(
+                    module_state_key=item.location,
+                    student=student,
+                    course_id=self.course.id,
+                    module_type='problem',
+                    state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        scope = {
+            'subsection': str(self.section.location),
+            'blocks': [str(self.items[0].location), str(self.items[2].location)],
+            'users': ['student2'],
+        }
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url', 'scope': scope}
+        task_input = {'data': data }
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            result = generate(
+                None, None, self.course.id,
+                task_input, 'EOL_Xblock_Completion'
+            )
+        self.assertEqual(result['total'], 2)
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        self._verify_csv_file_report(report_store, [
+            '"student2";"student2@edx.org"',
+            str(self.items[0].location),
+            str(self.items[2].location),
+        ])
+        self._verify_csv_file_report_notIn(report_store, ['"student";"student@edx.org"', str(self.items[1].location)])
+
+    def test_xblockcompletion_fingerprint_deleted_state(self):
+        """
+            Test the report fingerprint changes when a StudentModule row older than the last change is deleted
+        """
+        modules = [
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1}')
+            for item in self.items[:2]
+        ]
+        data = {'format': True, 'course': str(self.course.id), 'scope': {}}
+        fingerprint = XblockCompletionView().get_report_fingerprint(data)
+        modules[0].delete()
+        self.assertNotEqual(XblockCompletionView().get_report_fingerprint(data), fingerprint)
+
+    @override_settings(XBLOCKCOMPLETION_LIMIT_STUDENTS=0)
+    def test_xblockcompletion_reuse_report(self):
+        """
+            Test a report is reused while nothing changes and a running report is attached
+        """
+        module = StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url', 'scope': {}}
+        task_input = {'data': data }
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            result = generate(
+                None, None, self.course.id,
+                task_input, 'EOL_Xblock_Completion'
+            )
+        params = {'format': 'resumen', 'course': str(self.course.id)}
+        with patch('xblockcompletion.views.submit_task') as submit:
+            response = self.client_instructor.get(reverse('xblockcompletion-data:data'), params)
+        self.assertFalse(submit.called)
+        self.assertEqual(json.loads(response._container[0].decode())['report_name'], result['report_name'])
+        # the full report has other fingerprint
+        with patch('xblockcompletion.views.submit_task') as submit:
+            self.client_instructor.get(reverse('xblockcompletion-data:data'), dict(params, format='all'))
+        self.assertTrue(submit.called)
+        module.state = module.state.replace('"attempts": 1', '"attempts": 2')
+        module.save()
+        from lms.djangoapps.instructor_task.api_helper import AlreadyRunningError
+        from lms.djangoapps.instructor_task.models import InstructorTask
+        from .views import get_task_type_and_key
+        task_type, task_key = get_task_type_and_key(data)
+        running_task = InstructorTask.create(self.course.id, task_type, task_key, task_input, self.user_instructor)
+        with patch('xblockcompletion.views.submit_task', side_effect=AlreadyRunningError('running')) as submit:
+            response = self.client_instructor.get(reverse('xblockcompletion-data:data'), params)
+        self.assertTrue(submit.called)
+        self.assertEqual(json.loads(response._container[0].decode())['task_id'], running_task.task_id)
+
+    def test_xblockcompletion_course_user_states(self):
+        """
+            Test get_course_user_states group the student states by block, one page query per block
+        """
+        for item in self.items[:2]:
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1}')
+        StudentModule.objects.create(
+            module_state_key=self.items[2].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"seed": 1}')
+        with patch('xblockcompletion.views.get_user_id_doc_id_pairs', return_value=[]):
+            # enrolled students, blocks with states and one page of each block
+            with self.assertNumQueries(4):
+                course_states = [
+                    (block_key, list(states))
+                    for block_key, states in XblockCompletionView().get_course_user_states(self.course.id)
+                ]
+        self.assertEqual(
+            sorted(str(block_key) for block_key, states in course_states),
+            sorted(str(item.location) for item in self.items[:2]))
+        for block_key, states in course_states:
+            self.assertEqual(len(states), 1)
+            self.assertEqual(states[0]['student__username'], self.student.username)
+
+    @override_settings(XBLOCKCOMPLETION_CHUNK_SIZE=1)
+    def test_xblockcompletion_course_user_states_pages(self):
+        """
+            Test get_course_user_states read the states of a block by pages after the last student id
+        """
+        with patch('common.djangoapps.student.models.cc.User.save'):
+            student2 = UserFactory(username='student2', password='test', email='student2@edx.org')
+            CourseEnrollmentFactory(user=student2, course_id=self.course.id, mode='honor')
+        for student in (student2, self.student):
+            StudentModule.objects.create(
+                module_state_key=self.items[0].location,
+                student=student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1}')
+        with patch('xblockcompletion.views.get_user_id_doc_id_pairs', return_value=[]):
+            course_states = [
+                (block_key, [x['student__id'] for x in states])
+                for block_key, states in XblockCompletionView().get_course_user_states(self.course.id, [self.items[0].location])
+            ]
+        self.assertEqual(course_states, [(self.items[0].location, sorted([self.student.id, student2.id]))])
+
+    @patch('xblockcompletion.views.get_user_id_doc_id_pairs')
+    def test_xblockcompletion_set_doc_ids(self, doc_id_pairs):
+        """
+            Test set_doc_ids read the doc_id by user id and resolve each user once per report
+        """
+        doc_id_pairs.return_value = [(self.student.id, '000000001K')]
+        view = XblockCompletionView()
+        states = [
+            {'student__id': self.student.id, 'student__username': self.student.username},
+            {'student__id': self.user_instructor.id, 'student__username': self.user_instructor.username}
+        ]
+        view.set_doc_ids(states)
+        self.assertEqual(states[0]['doc_id'], '000000001K')
+        self.assertEqual(states[1]['doc_id'], '')
+        other_states = [{'student__id': self.student.id, 'student__username': self.student.username}]
+        view.set_doc_ids(other_states)
+        self.assertEqual(other_states[0]['doc_id'], '000000001K')
+        self.assertEqual(doc_id_pairs.call_count, 1)
+
+    @override_settings(XBLOCKCOMPLETION_DOC_ID_CACHE_TTL=600, XBLOCKCOMPLETION_DOC_ID_CACHE_SIZE=1)
+    @patch('xblockcompletion.views.get_user_id_doc_id_pairs')
+    def test_xblockcompletion_doc_id_cache(self, doc_id_pairs):
+        """
+            Test the doc_id cache is shared between reports and bounded in size
+        """
+        doc_id_pairs.return_value = [(self.student.id, '000000001K')]
+        states = [{'student__id': self.student.id, 'student__username': self.student.username}]
+        XblockCompletionView().set_doc_ids(states)
+        XblockCompletionView().set_doc_ids(states)
+        self.assertEqual(doc_id_pairs.call_count, 1)
+        self.assertEqual(states[0]['doc_id'], '000000001K')
+        doc_id_pairs.return_value = []
+        XblockCompletionView().set_doc_ids([{'student__id': self.user_instructor.id, 'student__username': self.user_instructor.username}])
+        XblockCompletionView().set_doc_ids(states)
+        self.assertEqual(doc_id_pairs.call_count, 3)
+        self.assertEqual(states[0]['doc_id'], '')
+
+    @override_settings(XBLOCKCOMPLETION_DOC_ID_CACHE_TTL=0)
+    @patch('xblockcompletion.views.get_user_id_doc_id_pairs')
+    def test_xblockcompletion_doc_id_cache_disabled(self, doc_id_pairs):
+        """
+            Test the doc_id cache is not used when the TTL is 0
+        """
+        doc_id_pairs.return_value = [(self.student.id, '000000001K')]
+        states = [{'student__id': self.student.id, 'student__username': self.student.username}]
+        XblockCompletionView().set_doc_ids(states)
+        XblockCompletionView().set_doc_ids(states)
+        self.assertEqual(doc_id_pairs.call_count, 2)
+
+    def test_xblockcompletion_course_outline(self):
+        """
+            Test get_course_outline index the problems in course order with their ancestors
+        """
+        with self.store.bulk_operations(self.course.id):
+            outline = XblockCompletionView().get_course_outline(self.course.id, self.store)
+        self.assertEqual([str(x) for x in outline], [str(item.location) for item in self.items])
+        for position, item in enumerate(self.items):
+            self.assertEqual(outline[item.location], {
+                'section': self.chapter.display_name,
+                'subsection': self.section.display_name,
+                'unit': self.subsection.display_name,
+                'position': position,
+                'ancestors': [str(self.chapter.location), str(self.section.location), str(self.subsection.location)],
+            })
+
+    def test_xblockcompletion_report_blocks(self):
+        """
+            Test get_report_blocks load the problems of the outline with one modulestore query
+        """
+        with self.store.bulk_operations(self.course.id):
+            outline = XblockCompletionView().get_course_outline(self.course.id, self.store)
+            del outline[self.items[2].location]
+            with patch.object(self.store, 'get_items', wraps=self.store.get_items) as get_items:
+                with patch.object(self.store, 'get_item', wraps=self.store.get_item) as get_item:
+                    blocks = XblockCompletionView().get_report_blocks(self.course.id, self.store, outline)
+        self.assertEqual(get_items.call_count, 1)
+        self.assertEqual(get_item.call_count, 0)
+        self.assertEqual(sorted(str(x) for x in blocks), sorted(str(x) for x in outline))
+        block = blocks[self.items[0].location]
+        self.assertEqual(block.display_name, self.items[0].display_name)
+        self.assertEqual(block.parent, self.subsection.location)
+
+    def test_xblockcompletion_course_user_states_course_order(self):
+        """
+            Test get_course_user_states yield the blocks in the given order
+        """
+        for item in reversed(self.items):
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1}')
+        block_keys = [self.items[1].location, self.items[2].location, self.items[0].location]
+        with patch('xblockcompletion.views.get_user_id_doc_id_pairs', return_value=[]):
+            course_states = [
+                (block_key, list(states))
+                for block_key, states in XblockCompletionView().get_course_user_states(self.course.id, block_keys)
+            ]
+        self.assertEqual([str(x[0]) for x in course_states], [str(x) for x in block_keys])
+        self.assertEqual([len(x[1]) for x in course_states], [1, 1, 1])
+
+    def test_xblockcompletion_compiled_problem(self):
+        """
+            Test the capa problem of a block is built once for students with the same seed
+        """
+        from capa.capa_problem import LoncapaProblem
+        problem = self._create_multiple_choice_problem()
+        answer_id = '{}_2_1'.format(problem.location.html_id())
+        with patch('common.djangoapps.student.models.cc.User.save'):
+            student2 = UserFactory(username='student2', password='test', email='student2@edx.org')
+            CourseEnrollmentFactory(user=student2, course_id=self.course.id, mode='honor')
+        for user, choice in [(self.student, 'choice_1'), (student2, 'choice_0')]:
+            StudentModule.objects.create(
+                module_state_key=problem.location,
+                student=user,
+                course_id=self.course.id,
+                module_type='problem',
+                state=json.dumps({
+                    'score': {'raw_earned': 1, 'raw_possible': 1},
+                    'seed': 1,
+                    'attempts': 1,
+                    'student_answers': {answer_id: choice},
+                    'correct_map': {answer_id: {'correctness': 'correct' if choice == 'choice_1' else 'incorrect'}}
+                }))
+        data = {'format': False, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        with patch('capa.capa_problem.LoncapaProblem', wraps=LoncapaProblem) as lcp:
+            with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                generate(
+                    None, None, self.course.id,
+                    task_input, 'EOL_Xblock_Completion'
+                )
+        self.assertEqual(lcp.call_count, 1)
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        self._verify_csv_file_report(report_store, [
+            '"{}";"{}"'.format(self.student.username, self.student.email),
+            '"{}";"{}"'.format(student2.username, student2.email),
+            '"2.0";"2.0";"2.0";"{}"'.format(str(problem.location)),
+            '"0.0";"2.0";"2.0";"{}"'.format(str(problem.location)),
+        ])
+
+    def test_xblockcompletion_materialized_answers(self):
+        """
+            Test the reports read from the materialized answers are equal to the reports built from the states
+        """
+        from django.core.management import call_command
+        from .answers import backfill_course_answers
+        problem = self._create_multiple_choice_problem()
+        answer_id = '{}_2_1'.format(problem.location.html_id())
+        StudentModule.objects.create(
+            module_state_key=problem.location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state=json.dumps({
+                'score': {'raw_earned': 1, 'raw_possible': 1},
+                'seed': 1,
+                'attempts': 2,
+                'has_saved_answers': True,
+                'student_answers': {answer_id: 'choice_1'},
+                'correct_map': {answer_id: {'correctness': 'correct'}}
+            }))
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "student_answers": {"id_question_2_1": "x"}, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        with patch('xblockcompletion.views.get_user_id_doc_id_pairs', return_value=[(self.student.id, '000000001K')]):
+            self.assertEqual(backfill_course_answers(self.course.id), 4)
+            for is_resumen in (True, False):
+                data = {'format': is_resumen, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+                live_rows = list(XblockCompletionView().get_report_rows(data))
+                with override_settings(XBLOCKCOMPLETION_MATERIALIZED_ANSWERS=True):
+                    with self.assertNumQueries(2):
+                        # enrolled students and answers
+                        materialized_rows = list(XblockCompletionView().get_report_rows(data))
+                self.assertEqual(len(live_rows), 3)
+                self.assertEqual([[str(x) for x in row] for row in materialized_rows], [[str(x) for x in row] for row in live_rows])
+            call_command('xblockcompletion_check_answers', str(self.course.id))
+
+    def test_xblockcompletion_gzip_report(self):
+        """
+            Test the report compressed with gzip
+        """
+        import gzip
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url', 'output': 'csv.gz'}
+        task_input = {'data': data }
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            result = generate(
+                None, None, self.course.id,
+                task_input, 'EOL_Xblock_Completion'
+            )
+        self.assertTrue(result['report_name'].endswith('.csv.gz'))
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        report_path = report_store.path_to(self.course.id, result['report_name'])
+        with report_store.storage.open(report_path) as report_file:
+            csv_file_data = gzip.decompress(report_file.read()).decode('utf-8-sig')
+        self.assertTrue(csv_file_data.startswith('"Username";"Email"'))
+        self.assertIn('"1";"3.0";"9.0";"{}"'.format(str(self.items[0].location)), csv_file_data)
+
+    def _write_report(self, output, rows):
+        """
+            Return the buffer of a report written by the writer of output
+        """
+        import io
+        from .views import _get_available_outputs, _get_report_writer
+        if output not in _get_available_outputs():
+            self.skipTest('{} output is not available'.format(output))
+        output_buffer = io.BytesIO()
+        report_writer = _get_report_writer(output, output_buffer)
+        for row in rows:
+            report_writer.writerow(row)
+        report_writer.close()
+        output_buffer.seek(0)
+        return output_buffer
+
+    def test_xblockcompletion_parquet_writer(self):
+        """
+            Test the parquet writer pads the optional columns and keeps the rows and numeric types
+        """
+        header = ['Username', 'Intentos', 'Pts Ganados', 'block id', 'Has saved answers']
+        rows = [['student', 1, 3.0, 'block1'], ['student2', 2, 0.0, 'block1', 'has_saved_answers']]
+        output_buffer = self._write_report('parquet', [header] + rows)
+        import pyarrow.parquet as pq
+        table = pq.read_table(output_buffer)
+        self.assertEqual(table.column_names, header)
+        self.assertEqual(table.to_pydict()['Has saved answers'], ['', 'has_saved_answers'])
+        # the numeric columns keep their type
+        self.assertEqual(str(table.schema.field('Intentos').type), 'int64')
+        self.assertEqual(table.to_pydict()['Pts Ganados'], [3.0, 0.0])
+
+    def test_xblockcompletion_xlsx_writer(self):
+        """
+            Test the xlsx writer keeps the rows and numeric types
+        """
+        header = ['Username', 'Intentos', 'Pts Ganados', 'block id', 'Has saved answers']
+        rows = [['student', 1, 3.0, 'block1'], ['student2', 2, 0.0, 'block1', 'has_saved_answers']]
+        output_buffer = self._write_report('xlsx', [header] + rows)
+        from openpyxl import load_workbook
+        worksheet = load_workbook(output_buffer, read_only=True).worksheets[0]
+        self.assertEqual([list(x) for x in worksheet.iter_rows(values_only=True)], [header, rows[0] + [None], rows[1]])
+
+    def test_xblockcompletion_export_command(self):
+        """
+            Test the export command generates the reports and skips the reports of its state file
+        """
+        import tempfile
+        from io import StringIO
+        from django.core.management import call_command
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        with tempfile.NamedTemporaryFile(suffix='.json') as state_file:
+            state_file.write(b'{"done": {}}')
+            state_file.flush()
+            out = StringIO()
+            call_command('xblockcompletion_export', str(self.course.id), format='resumen', state_file=state_file.name, stdout=out)
+            self.assertEqual(len(report_store.links_for(self.course.id)), 1)
+            summary = json.loads(out.getvalue().splitlines()[0])
+            self.assertEqual((summary['rows'], summary['failed_blocks']), (1, 0))
+            with open(state_file.name) as f:
+                self.assertEqual(list(json.load(f)['done']), ['{}|resumen'.format(str(self.course.id))])
+            call_command('xblockcompletion_export', org=[self.course.id.org], format='resumen', state_file=state_file.name)
+        self.assertEqual(len(report_store.links_for(self.course.id)), 1)
+        self._verify_csv_file_report(report_store, ['"1";"3.0";"9.0";"{}"'.format(str(self.items[0].location))])
+
+    @override_settings(XBLOCKCOMPLETION_MATERIALIZED_ANSWERS=True)
+    def test_xblockcompletion_materialized_answers_update(self):
+        """
+            Test the StudentModule changes of a transaction are sent in one batch when it is committed
+        """
+        with patch('xblockcompletion.answers.update_materialized_answers.delay') as update:
+            with self.captureOnCommitCallbacks(execute=True):
+                modules = [
+                    StudentModule.objects.create(
+                        module_state_key=item.location,
+                        student=self.student,
+                        course_id=self.course.id,
+                        module_type='problem',
+                        state='{"attempts": 1}')
+                    for item in self.items
+                ]
+        update.assert_called_once_with(sorted(x.id for x in modules))
+
+    @override_settings(XBLOCKCOMPLETION_MATERIALIZED_ANSWERS=True)
+    def test_xblockcompletion_materialized_answers_rollback(self):
+        """
+            Test the StudentModule changes of a transaction are sent after a rolled back transaction
+        """
+        from django.db import transaction
+        with patch('xblockcompletion.answers.update_materialized_answers.delay') as update:
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    StudentModule.objects.create(
+                        module_state_key=self.items[0].location,
+                        student=self.student,
+                        course_id=self.course.id,
+                        module_type='problem',
+                        state='{"attempts": 1}')
+                    raise ValueError()
+            with self.captureOnCommitCallbacks(execute=True):
+                module = StudentModule.objects.create(
+                    module_state_key=self.items[1].location,
+                    student=self.student,
+                    course_id=self.course.id,
+                    module_type='problem',
+                    state='{"attempts": 1}')
+        update.assert_called_once_with([module.id])
+
+    def test_xblockcompletion_materialized_answers_students(self):
+        """
+            Test the backfill includes the students who are not enrolled yet and the rows of a deleted state are deleted
+        """
+        from .answers import backfill_course_answers
+        from .models import XblockCompletionAnswer
+        modules = [
+            StudentModule.objects.create(
+                module_state_key=self.items[0].location,
+                student=user,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+            for user in [self.student, self.data_researcher_user]
+        ]
+        backfill_course_answers(self.course.id)
+        answers = XblockCompletionAnswer.objects.filter(course_id=self.course.id, report_format='resumen')
+        self.assertEqual(sorted(answers.values_list('student_id', flat=True)), sorted([self.student.id, self.data_researcher_user.id]))
+        with override_settings(XBLOCKCOMPLETION_MATERIALIZED_ANSWERS=True):
+            modules[0].delete()
+        self.assertEqual(list(answers.values_list('student_id', flat=True)), [self.data_researcher_user.id])
+
+    def test_xblockcompletion_compiled_problem_by_seed(self):
+        """
+            Test the capa problem of a block is built once per seed, bounded in size, with the rows in the states order
+        """
+        from capa.capa_problem import LoncapaProblem
+        problem = ReportBlock.from_xblock(self.store.get_item(self._create_multiple_choice_problem().location))
+        answer_id = '{}_2_1'.format(problem.location.html_id())
+        student_states = [
+            {
+                'student__username': 'student{}'.format(i),
+                'student__email': 'student{}@edx.org'.format(i),
+                'doc_id': '',
+                'state': json.dumps({
+                    'score': {'raw_earned': 0, 'raw_possible': 1},
+                    'seed': seed,
+                    'attempts': 1,
+                    'student_answers': {answer_id: 'choice_0'},
+                    'correct_map': {answer_id: {'correctness': 'incorrect'}}
+                })
+            }
+            for i, seed in enumerate([1, 2, 1, 2, 3, 1])
+        ]
+        with patch('capa.capa_problem.LoncapaProblem', wraps=LoncapaProblem) as lcp:
+            rows = list(XblockCompletionView().generate_report_data(problem, student_states))
+        self.assertEqual(lcp.call_count, 3)
+        self.assertEqual([x['username'] for x in rows], [x['student__username'] for x in student_states])
+        # the states are grouped by seed, one compiled problem is enough
+        with override_settings(XBLOCKCOMPLETION_COMPILED_PROBLEMS_SIZE=1):
+            with patch('capa.capa_problem.LoncapaProblem', wraps=LoncapaProblem) as lcp:
+                rows = list(XblockCompletionView().generate_report_data(problem, student_states))
+        self.assertEqual(lcp.call_count, 3)
+        self.assertEqual([x['username'] for x in rows], [x['student__username'] for x in student_states])
+
+    def test_xblockcompletion_report_data_streamed(self):
+        """
+            Test the student states of a problem without randomization are not buffered
+        """
+        problem = ReportBlock.from_xblock(self.store.get_item(self._create_multiple_choice_problem().location))
+        answer_id = '{}_2_1'.format(problem.location.html_id())
+        student_states = iter([
+            {
+                'student__username': 'student{}'.format(i),
+                'student__email': 'student{}@edx.org'.format(i),
+                'doc_id': '',
+                'state': json.dumps({
+                    'score': {'raw_earned': 0, 'raw_possible': 1},
+                    'seed': 1,
+                    'attempts': 1,
+                    'student_answers': {answer_id: 'choice_0'},
+                    'correct_map': {answer_id: {'correctness': 'incorrect'}}
+                })
+            }
+            for i in range(3)
+        ])
+        rows = XblockCompletionView().generate_report_data(problem, student_states)
+        self.assertEqual(next(rows)['username'], 'student0')
+        self.assertEqual(len(list(student_states)), 2)
+
+    def test_xblockcompletion_failed_problem(self):
+        """
+            Test a capa problem that fails to compile is built once per seed and reported in the stats
+        """
+        problem = ReportBlock.from_xblock(self.store.get_item(self._create_multiple_choice_problem().location))
+        answer_id = '{}_2_1'.format(problem.location.html_id())
+        student_states = [
+            {
+                'student__username': 'student{}'.format(i),
+                'student__email': 'student{}@edx.org'.format(i),
+                'doc_id': '',
+                'state': json.dumps({
+                    'score': {'raw_earned': 1, 'raw_possible': 2},
+                    'seed': seed,
+                    'attempts': 1,
+                    'student_answers': {answer_id: 'choice_0', answer_id + 'b': 'choice_1'},
+                    'correct_map': {answer_id: {'correctness': 'correct'}, answer_id + 'b': {'correctness': 'incorrect'}}
+                })
+            }
+            for i, seed in enumerate([1, 1, 2, 1])
+        ]
+        view = XblockCompletionView()
+        with patch('capa.capa_problem.LoncapaProblem', side_effect=Exception('bad xml')) as lcp:
+            rows = list(view.generate_report_data(problem, student_states))
+        self.assertEqual(lcp.call_count, 2)
+        self.assertEqual([x['username'] for x in rows], [x['student__username'] for x in student_states])
+        self.assertEqual([(x['gained'], x['possible']) for x in rows], [(1.0, 2.0)] * 4)
+        self.assertEqual(view.stats.failed_blocks, {str(problem.location): [4, 'bad xml']})
+        self.assertEqual(view.stats.get_meta()['failed_blocks'], [str(problem.location)])
+        # the errors reading the answers are counted by block, not logged by student
+        view = XblockCompletionView()
+        with patch('xblockcompletion.views.CompiledProblem.question', side_effect=Exception('bad label')):
+            with patch('xblockcompletion.views.logger') as logger:
+                rows = list(view.generate_report_data(problem, student_states))
+        self.assertFalse(logger.error.called)
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(view.stats.failed_blocks, {str(problem.location): [4, 'bad label']})
+
+    @override_settings(XBLOCKCOMPLETION_SPOOL_MAX_SIZE=16)
+    def test_xblockcompletion_spooled_report(self):
+        """
+            Test the report is uploaded in chunks when it is spooled to disk
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 2, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        with patch('lms.djangoapps.instructor_task.models.DjangoStorageReportStore.store') as store:
+            with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                generate(
+                    None, None, self.course.id,
+                    task_input, 'EOL_Xblock_Completion'
+                )
+        self.assertFalse(store.called)
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        student_row = ";".join([
+            '"{}"'.format(self.student.username),
+            '"{}"'.format(self.student.email),
+            '""',
+            '"{}"'.format(self.chapter.display_name),
+            '"{}"'.format(self.section.display_name),
+            '"{}"'.format(self.subsection.display_name),
+            '"{}"'.format(self.items[0].display_name),
+            '"2"', '"9.0"', '"9.0"', '"{}"'.format(str(self.items[0].location))
+        ])
+        self._verify_csv_file_report(report_store, [student_row])
+
+    def test_xblockcompletion_build_block_rows_missing_block(self):
+        """
+            Test a process worker returns the block as failed when it can not read it from the modulestore
+        """
+        from .views import _build_block_rows
+        student_states = [{'student__id': self.student.id}]
+        with patch('xblockcompletion.views.modulestore') as store:
+            store.return_value.get_item.side_effect = Exception('error')
+            rows, failed_blocks = _build_block_rows(
+                str(self.course.id), str(self.items[0].location), {}, student_states, True)
+        self.assertEqual(rows, [])
+        self.assertEqual(failed_blocks, {str(self.items[0].location): [1, 'error']})
+
+    @override_settings(XBLOCKCOMPLETION_PARALLEL_WORKERS=2, XBLOCKCOMPLETION_PARALLEL_BACKEND='thread')
+    def test_xblockcompletion_parallel_report(self):
+        """
+            Test the rows built by the pool of workers are written in course order
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        for item in reversed(self.items):
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            generate(
+                None, None, self.course.id,
+                task_input, 'EOL_Xblock_Completion'
+            )
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        report_csv_filename = report_store.links_for(self.course.id)[0][0]
+        report_path = report_store.path_to(self.course.id, report_csv_filename)
+        with report_store.storage.open(report_path) as csv_file:
+            csv_file_data = csv_file.read().decode("utf-8-sig")
+        positions = [csv_file_data.index('"{}"'.format(str(item.location))) for item in self.items]
+        self.assertEqual(positions, sorted(positions))
+
+    @override_settings(XBLOCKCOMPLETION_SHARD_BLOCKS=1, XBLOCKCOMPLETION_SHARD_POLL_INTERVAL=0)
+    def test_xblockcompletion_sharded_report(self):
+        """
+            Test the report generated by shard subtasks is merged in course order
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        for item in self.items:
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            result = generate(
+                None, None, self.course.id,
+                task_input, 'EOL_Xblock_Completion'
+            )
+        self.assertEqual(result['total'], 3)
+        self.assertEqual(result['succeeded'], 3)
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        self.assertEqual(len(report_store.links_for(self.course.id)), 1)
+        report_csv_filename = report_store.links_for(self.course.id)[0][0]
+        report_path = report_store.path_to(self.course.id, report_csv_filename)
+        with report_store.storage.open(report_path) as csv_file:
+            csv_file_data = csv_file.read().decode("utf-8-sig")
+        self.assertEqual(csv_file_data.count('"Username"'), 1)
+        positions = [csv_file_data.index('"{}"'.format(str(item.location))) for item in self.items]
+        self.assertEqual(positions, sorted(positions))
+
+    @override_settings(XBLOCKCOMPLETION_SHARD_BLOCKS=1, XBLOCKCOMPLETION_SHARD_QUEUE='edx.lms.core.low')
+    def test_xblockcompletion_sharded_report_same_queue(self):
+        """
+            Test the report is not sharded when the shard queue is the queue of the report task
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            with patch('xblockcompletion.views._generate_sharded') as generate_sharded:
+                generate(
+                    None, None, self.course.id,
+                    task_input, 'EOL_Xblock_Completion'
+                )
+        self.assertFalse(generate_sharded.called)
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        self.assertEqual(len(report_store.links_for(self.course.id)), 1)
+
+    @override_settings(XBLOCKCOMPLETION_INCREMENTAL=True, XBLOCKCOMPLETION_INCREMENTAL_OVERLAP=0)
+    def test_xblockcompletion_incremental_report(self):
+        """
+            Test the incremental report only process the student states modified since the last report
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        module = StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        StudentModule.objects.create(
+            module_state_key=self.items[1].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 0, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "incorrect"}}}')
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            generate(
+                None, None, self.course.id,
+                task_input, 'EOL_Xblock_Completion'
+            )
+        self.assertEqual(XblockCompletionBlockReport.objects.filter(course_id=self.course.id, report_format='resumen').count(), 2)
+        module.state = '{"score": {"raw_earned": 0, "raw_possible": 3}, "seed": 1, "attempts": 5, "correct_map": {"id_question_2_1": {"correctness": "incorrect"}}}'
+        module.save()
+        with patch.object(XblockCompletionView, 'get_block_rows', autospec=True, side_effect=XblockCompletionView.get_block_rows) as block_rows:
+            with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                generate(
+                    None, None, self.course.id,
+                    task_input, 'EOL_Xblock_Completion'
+                )
+        self.assertEqual([x[0][1] for x in block_rows.call_args_list], [self.items[0].location])
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        report_csv_filename = report_store.links_for(self.course.id)[0][0]
+        report_path = report_store.path_to(self.course.id, report_csv_filename)
+        with report_store.storage.open(report_path) as csv_file:
+            csv_file_data = csv_file.read().decode("utf-8-sig")
+        self.assertIn('"5";"0.0";"9.0";"{}"'.format(str(self.items[0].location)), csv_file_data)
+        self.assertIn('"1";"0.0";"9.0";"{}"'.format(str(self.items[1].location)), csv_file_data)
+
+    @override_settings(XBLOCKCOMPLETION_INCREMENTAL=True, XBLOCKCOMPLETION_INCREMENTAL_OVERLAP=0)
+    def test_xblockcompletion_incremental_report_students(self):
+        """
+            Test the incremental report adds the students enrolled after the watermark and removes the deleted states
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        modules = [
+            StudentModule.objects.create(
+                module_state_key=self.items[0].location,
+                student=user,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+            for user in [self.data_researcher_user, self.student]
+        ]
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+        block_report = XblockCompletionBlockReport.objects.get(course_id=self.course.id, report_format='resumen')
+        self.assertEqual(list(json.loads(block_report.rows)), [str(self.student.id)])
+        # the state of the audit student is older than the watermark
+        with override_settings(XBLOCKCOMPLETION_ENROLLMENT_MODES=['honor', 'audit']):
+            with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+        block_report.refresh_from_db()
+        self.assertEqual(sorted(json.loads(block_report.rows), key=int), sorted([str(self.student.id), str(self.data_researcher_user.id)], key=int))
+        modules[1].delete()
+        with override_settings(XBLOCKCOMPLETION_ENROLLMENT_MODES=['honor', 'audit']):
+            with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+        block_report.refresh_from_db()
+        self.assertEqual(list(json.loads(block_report.rows)), [str(self.data_researcher_user.id)])
+
+    @override_settings(XBLOCKCOMPLETION_PROGRESS_INTERVAL=0)
+    def test_xblockcompletion_pipeline_report(self):
+        """
+            Test the report built in the pipeline is equal to the report built in one thread
+        """
+        import io
+        from .views import _get_csvwriter
+        for i, item in enumerate(self.items):
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": %d, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}' % i)
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        reports = []
+        for queue_size in [0, 1]:
+            output_buffer = io.BytesIO()
+            with override_settings(XBLOCKCOMPLETION_PIPELINE_QUEUE_SIZE=queue_size):
+                view = XblockCompletionView()
+                view._build_student_data(data, _get_csvwriter(output_buffer))
+            self.assertEqual(view.stats.blocks_processed, 3)
+            reports.append(output_buffer.getvalue())
+        self.assertEqual(reports[0], reports[1])
+        self.assertEqual(reports[0].count(b'\n'), 4)
+        with override_settings(XBLOCKCOMPLETION_PIPELINE_QUEUE_SIZE=1):
+            with patch.object(XblockCompletionView, 'get_block_rows', side_effect=ValueError('bad block')):
+                with self.assertRaises(ValueError):
+                    XblockCompletionView()._build_student_data(data, _get_csvwriter(io.BytesIO()))
+
+    @override_settings(XBLOCKCOMPLETION_CHECKPOINT_BLOCKS=1)
+    def test_xblockcompletion_checkpointed_report(self):
+        """
+            Test a failed report task is resumed from its checkpoint
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        for item in self.items:
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        get_block_rows = XblockCompletionView.get_block_rows
+
+        def fail_last_block(view, block_key, *args):
+            if block_key == self.items[2].location:
+                raise ValueError('worker restarted')
+            return get_block_rows(view, block_key, *args)
+        with patch.object(XblockCompletionView, 'get_block_rows', autospec=True, side_effect=fail_last_block):
+            with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                with self.assertRaises(ValueError):
+                    generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+        checkpoint = XblockCompletionCheckpoint.objects.get(course_id=self.course.id)
+        self.assertEqual([x['blocks'] for x in json.loads(checkpoint.parts)], [[str(self.items[0].location)], [str(self.items[1].location)]])
+        # the states changed after the first parts, the report is not reused as up to date
+        module = StudentModule.objects.get(module_state_key=self.items[0].location)
+        module.state = module.state.replace('"attempts": 1', '"attempts": 2')
+        module.save()
+        self.assertNotEqual(XblockCompletionView().get_report_fingerprint(data), checkpoint.fingerprint)
+        with patch.object(XblockCompletionView, 'get_block_rows', autospec=True, side_effect=get_block_rows) as block_rows:
+            with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                result = generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+        self.assertEqual(block_rows.call_count, 1)
+        self.assertEqual(result['parts_total'], 3)
+        self.assertEqual(result['blocks_processed'], 3)
+        self.assertEqual(result['blocks_total'], 3)
+        self.assertFalse(XblockCompletionCheckpoint.objects.exists())
+        self.assertEqual(XblockCompletionReport.objects.get(course_id=self.course.id).fingerprint, checkpoint.fingerprint)
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        report_path = report_store.path_to(self.course.id, result['report_name'])
+        with report_store.storage.open(report_path) as csv_file:
+            csv_file_data = csv_file.read().decode("utf-8-sig")
+        self.assertEqual(csv_file_data.count('"Username"'), 1)
+        positions = [csv_file_data.index('"{}"'.format(str(item.location))) for item in self.items]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_xblockcompletion_checkpointed_report_partition(self):
+        """
+            Test the parts of a checkpoint generated with other XBLOCKCOMPLETION_CHECKPOINT_BLOCKS are generated again
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        for item in self.items:
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        get_block_rows = XblockCompletionView.get_block_rows
+
+        def fail_last_block(view, block_key, *args):
+            if block_key == self.items[2].location:
+                raise ValueError('worker restarted')
+            return get_block_rows(view, block_key, *args)
+        with override_settings(XBLOCKCOMPLETION_CHECKPOINT_BLOCKS=1):
+            with patch.object(XblockCompletionView, 'get_block_rows', autospec=True, side_effect=fail_last_block):
+                with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                    with self.assertRaises(ValueError):
+                        generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+        with override_settings(XBLOCKCOMPLETION_CHECKPOINT_BLOCKS=2):
+            with patch.object(XblockCompletionView, 'get_block_rows', autospec=True, side_effect=get_block_rows) as block_rows:
+                with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                    result = generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+        self.assertEqual(block_rows.call_count, 3)
+        self.assertEqual(result['parts_total'], 2)
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        with report_store.storage.open(report_store.path_to(self.course.id, result['report_name'])) as csv_file:
+            csv_file_data = csv_file.read().decode("utf-8-sig")
+        for item in self.items:
+            self.assertEqual(csv_file_data.count('"{}"'.format(str(item.location))), 1)
+
+    def test_xblockcompletion_report_progress(self):
+        """
+            Test the report task meta include the progress counters and the timing by stage
+        """
+        data = {'format': True, 'course': str(self.course.id), 'base_url':'this_is_a_url'}
+        task_input = {'data': data }
+        for item in self.items[:2]:
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1, "correct_map": {"id_question_2_1": {"correctness": "correct"}}}')
+        with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+            result = generate(
+                None, None, self.course.id,
+                task_input, 'EOL_Xblock_Completion'
+            )
+        self.assertEqual(result['blocks_total'], 3)
+        self.assertEqual(result['blocks_processed'], 3)
+        self.assertEqual(result['rows_written'], 2)
+        self.assertEqual(result['students_processed'], 1)
+        self.assertEqual(
+            set(result['timing']),
+            set(['db_fetch', 'identity', 'modulestore', 'xml', 'csv', 'upload']))
+
+    def test_xblockcompletion_resumen_state(self):
+        """
+            Test get_resumen_state read the score from the grade columns and extract the other fields without parsing the state
+        """
+        view = XblockCompletionView()
+        response = {
+            'student__id': self.student.id,
+            'module_state_key': self.items[0].location,
+            'grade': 2.0,
+            'max_grade': 3.0,
+            'state': '{"seed": 1, "attempts": 4, "has_saved_answers": true, "student_answers": {"a_2_1": "\\"correctness\\": x"}, "correct_map": {"a_2_1": {"correctness": "correct"}, "a_3_1": {"correctness": "incorrect"}}}'
+        }
+        with patch('xblockcompletion.views.json.loads') as loads:
+            user_state = view.get_resumen_state(response)
+        self.assertFalse(loads.called)
+        self.assertEqual(user_state, {
+            'attempts': 4,
+            'correct_map_size': 2,
+            'has_saved_answers': True,
+            'raw_earned': 2.0,
+            'raw_possible': 3.0,
+        })
+        response['grade'] = None
+        response['state'] = '{"seed": 1, "attempts": 1, "score": {"raw_earned": 1, "raw_possible": 3}, "correct_map": {"a_2_1": {"correctness": "correct"}}}'
+        self.assertEqual(view.get_resumen_state(response), {
+            'attempts': 1,
+            'correct_map_size': 1,
+            'has_saved_answers': False,
+            'raw_earned': 1,
+            'raw_possible': 3,
+        })
+        response['state'] = '{"seed": 1, "attempts": 1, "correct_map": null}'
+        self.assertIsNone(view.get_resumen_state(response))
+        # only the answers of the correct_map are counted
+        response['grade'] = 1.0
+        response['state'] = '{"seed": 1, "attempts": 1, "input_state": {"a_2_1": {"correctness": "x"}}, "correct_map": {"a_2_1": {"correctness": "correct", "hint": {"correctness": "x"}}}}'
+        with patch('xblockcompletion.views.json.loads') as loads:
+            self.assertEqual(view.get_resumen_state(response)['correct_map_size'], 1)
+        self.assertFalse(loads.called)
+        response['state'] = '{"seed": 1, "attempts": 1, "input_state": {"a_2_1": {"correctness": "x"}}, "correct_map": null}'
+        self.assertIsNone(view.get_resumen_state(response))
+
+    def test_xblockcompletion_enrollment_modes(self):
+        """
+            Test only the students enrolled in XBLOCKCOMPLETION_ENROLLMENT_MODES are included
+        """
+        for user in [self.student, self.data_researcher_user]:
+            StudentModule.objects.create(
+                module_state_key=self.items[0].location,
+                student=user,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1}')
+        with patch('xblockcompletion.views.get_user_id_doc_id_pairs', return_value=[]):
+            course_states = [
+                (block_key, [x['student__id'] for x in states])
+                for block_key, states in XblockCompletionView().get_course_user_states(self.course.id)
+            ]
+            self.assertEqual(course_states[0][1], [self.student.id])
+            with override_settings(XBLOCKCOMPLETION_ENROLLMENT_MODES=['honor', 'audit'], XBLOCKCOMPLETION_STUDENTS_CHUNK_SIZE=1):
+                course_states = [
+                    (block_key, [x['student__id'] for x in states])
+                    for block_key, states in XblockCompletionView().get_course_user_states(self.course.id)
+                ]
+        self.assertEqual(course_states[0][1], sorted([self.student.id, self.data_researcher_user.id]))
+
+    def test_xblockcompletion_read_db(self):
+        """
+            Test the report read queries use XBLOCKCOMPLETION_READ_DB and fall back to
+            the default database when it does not exist, fails or is behind
+        """
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1}')
+        with patch('xblockcompletion.views.XblockCompletionView.get_replica_lag') as get_replica_lag:
+            self.assertEqual(XblockCompletionView().get_db_alias(self.course.id), 'default')
+            with override_settings(XBLOCKCOMPLETION_READ_DB='replica'):
+                self.assertEqual(XblockCompletionView().get_db_alias(self.course.id), 'default')
+            self.assertFalse(get_replica_lag.called)
+            databases = dict(settings.DATABASES, replica=settings.DATABASES['default'])
+            with override_settings(XBLOCKCOMPLETION_READ_DB='replica', XBLOCKCOMPLETION_READ_DB_MAX_LAG=60, DATABASES=databases):
+                get_replica_lag.return_value = 5
+                view = XblockCompletionView()
+                self.assertEqual(view.get_db_alias(self.course.id), 'replica')
+                self.assertEqual(view.get_db_alias(self.course.id), 'replica')
+                self.assertEqual(get_replica_lag.call_count, 1)
+                get_replica_lag.return_value = 120
+                self.assertEqual(XblockCompletionView().get_db_alias(self.course.id), 'default')
+                get_replica_lag.return_value = None
+                self.assertEqual(XblockCompletionView().get_db_alias(self.course.id), 'default')
+                get_replica_lag.side_effect = DatabaseError('replica')
+                self.assertEqual(XblockCompletionView().get_db_alias(self.course.id), 'default')
+        self.assertEqual(XblockCompletionView().get_replica_lag('default', self.course.id), 0)
+
+    def test_xblockcompletion_answer_distribution(self):
+        """
+            Test the answer distribution counts the answers, correctness, attempts and scores of the students
+        """
+        def report(username, answer_id, answer, correct, attempts):
+            return {
+                'username': username, 'answer_id': answer_id, 'question': 'q {}'.format(answer_id),
+                'answer': answer, 'correct_answer': 'a', 'correct': correct, 'attempts': attempts,
+                'gained': 4.5 if correct else 0.0, 'total': 9.0,
+            }
+        distribution = AnswerDistribution(max_answers=2, buckets=2)
+        for x in [
+                report('s1', 'q1', 'a', True, 1), report('s1', 'q2', 'a', True, 1),
+                report('s2', 'q1', 'b', False, 3), report('s2', 'q2', 'a', True, 3),
+                report('s3', 'q1', 'c', False, 2), report('s3', 'q2', 'b', False, 2)]:
+            distribution.add(x)
+        self.assertEqual(distribution.get_rows(), [
+            ['q q1', 'a', 'Total', 3, 100.0, 33.33, 2.0],
+            ['q q1', 'a', 'a', 1, 33.33, 100.0, ''],
+            ['q q1', 'a', 'b', 1, 33.33, 0.0, ''],
+            ['q q1', 'a', 'Otras respuestas', 1, 33.33, 0.0, ''],
+            ['q q2', 'a', 'Total', 3, 100.0, 66.67, 2.0],
+            ['q q2', 'a', 'a', 2, 66.67, 100.0, ''],
+            ['q q2', 'a', 'b', 1, 33.33, 0.0, ''],
+            ['Puntaje', '', '0-50%', 1, 33.33, '', ''],
+            ['Puntaje', '', '50-100%', 2, 66.67, '', ''],
+        ])
+
+    def test_xblockcompletion_distribution_report(self):
+        """
+            Test the distribution report has the aggregates of each block and no student rows
+        """
+        import io
+        from .views import _get_csvwriter
+        StudentModule.objects.create(
+            module_state_key=self.items[0].location,
+            student=self.student,
+            course_id=self.course.id,
+            module_type='problem',
+            state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1}')
+        reports = [{
+            'username': 'student', 'email': 'student@edx.org', 'answer_id': 'q1', 'question': 'question',
+            'answer': 'answer', 'correct_answer': 'answer', 'correct': True, 'attempts': 1, 'gained': 9.0, 'total': 9.0,
+        }]
+        data = {'format': False, 'distribution': True, 'course': str(self.course.id), 'base_url': 'this_is_a_url'}
+        output_buffer = io.BytesIO()
+        with patch('xblockcompletion.views.get_user_id_doc_id_pairs', return_value=[]):
+            with patch.object(XblockCompletionView, 'generate_report_data', return_value=reports) as generate_report_data:
+                XblockCompletionView()._build_student_data(data, _get_csvwriter(output_buffer))
+        self.assertEqual(generate_report_data.call_count, 1)
+        report = output_buffer.getvalue().decode('utf-8-sig')
+        self.assertIn('"Porcentaje Correctas"', report)
+        self.assertIn('"question";"answer";"Total";"1";"100.0";"100.0";"1.0"', report)
+        self.assertIn('"question";"answer";"answer";"1";"100.0";"100.0";""', report)
+        self.assertIn('"Puntaje";"";"90-100%";"1";"100.0"', report)
+        self.assertNotIn('student@edx.org', report)
+        self.assertEqual(report.count('\n'), 1 + 2 + 10)
+
+    @override_settings(XBLOCKCOMPLETION_CHECKPOINT_BLOCKS=1)
+    def test_xblockcompletion_checkpointed_distribution_report(self):
+        """
+            Test the distribution report generated by parts has the distribution header
+        """
+        data = {'format': False, 'distribution': True, 'course': str(self.course.id), 'base_url': 'this_is_a_url'}
+        task_input = {'data': data}
+        for item in self.items:
+            StudentModule.objects.create(
+                module_state_key=item.location,
+                student=self.student,
+                course_id=self.course.id,
+                module_type='problem',
+                state='{"score": {"raw_earned": 1, "raw_possible": 3}, "seed": 1, "attempts": 1}')
+        reports = [{
+            'username': 'student', 'email': 'student@edx.org', 'answer_id': 'q1', 'question': 'question',
+            'answer': 'answer', 'correct_answer': 'answer', 'correct': True, 'attempts': 1, 'gained': 9.0, 'total': 9.0,
+        }]
+        with patch('xblockcompletion.views.get_user_id_doc_id_pairs', return_value=[]):
+            with patch.object(XblockCompletionView, 'generate_report_data', return_value=reports):
+                with patch('lms.djangoapps.instructor_task.tasks_helper.runner._get_current_task'):
+                    result = generate(None, None, self.course.id, task_input, 'EOL_Xblock_Completion')
+        self.assertEqual(result['parts_total'], 3)
+        self.assertIn('Distribucion', result['report_name'])
+        report_store = ReportStore.from_config(config_name='GRADES_DOWNLOAD')
+        with report_store.storage.open(report_store.path_to(self.course.id, result['report_name'])) as csv_file:
+            csv_file_data = csv_file.read().decode("utf-8-sig")
+        self.assertTrue(csv_file_data.startswith('"Seccion";"SubSeccion";"Unidad";"Titulo";"block id";"Pregunta"'))
+        self.assertNotIn('"Username"', csv_file_data)
+        self.assertEqual(csv_file_data.count('"Total"'), 3)
@@ -3,17 +3,36 @@
 # Python Standard Libraries
 import codecs
 import csv
+import gzip
+import hashlib
 import json
 import logging
-from datetime import datetime
+import multiprocessing
+import queue
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
 from functools import partial
-from time import time
+from itertools import chain, groupby, islice
+from operator import itemgetter
+from time import perf_counter, sleep, time
 
 # Installed packages (via pip)
-from celery import task
-from django.core.files.base import ContentFile
-from django.db import transaction
-from django.http import Http404, JsonResponse
+from celery import group, task
+from celery.states import READY_STATES
+from django.conf import settings
+from django.core.files.base import File
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.db.models import Case, CharField, Count, IntegerField, Max, Sum, Value, When
+from django.db.models.expressions import RawSQL
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.translation import gettext as _, ugettext_noop
 from django.views.generic.base import View
 from pytz import UTC
@@ -21,6 +40,7 @@ from uchileedxlogin.services.interface import get_user_id_doc_id_pairs
 import six
 
 # Edx dependencies
+from common.djangoapps.student.models import CourseEnrollment
 from common.djangoapps.util.file import course_filename_prefix_generator
 from lms.djangoapps.courseware.access import has_access
 from lms.djangoapps.courseware.courses import get_course_with_access
@@ -29,21 +49,36 @@ from lms.djangoapps.instructor import permissions
 from lms.djangoapps.instructor_task.api_helper import submit_task, AlreadyRunningError
 from lms.djangoapps.instructor_task.tasks_helper.runner import run_main_task, TaskProgress
 from lms.djangoapps.instructor_task.tasks_base import BaseInstructorTask
-from lms.djangoapps.instructor_task.models import ReportStore
+from lms.djangoapps.instructor_task.models import InstructorTask, ReportStore
 from opaque_keys import InvalidKeyError
-from opaque_keys.edx.keys import CourseKey
+from opaque_keys.edx.keys import CourseKey, UsageKey
+from openedx.core.djangoapps.course_groups.models import CohortMembership, CourseUserGroup
 from xmodule.modulestore.django import modulestore
 
+# Internal project dependencies
+from .models import XblockCompletionAnswer, XblockCompletionBlockReport, XblockCompletionCheckpoint, XblockCompletionReport
+
 logger = logging.getLogger(__name__)
 
-def task_process_data(request, data):
-    course_key = CourseKey.from_string(data['course'])
+def get_task_type_and_key(data):
     task_type = 'EOL_Xblock_Completion'
     if data['format']:
         task_type = 'EOL_Xblock_Completion_Resumen'
+    elif data.get('distribution'):
+        task_type = 'EOL_Xblock_Completion_Distribucion'
+    task_key = "EOL_Xblock_Completion_{}".format(data['course'])
+    if data.get('scope'):
+        # scoped reports of the same course can run at the same time
+        task_key = "{}_{}".format(task_key, hashlib.md5(json.dumps(data['scope'], sort_keys=True).encode('utf-8')).hexdigest())
+    if data.get('output', 'csv') != 'csv':
+        task_key = "{}_{}".format(task_key, data['output'])
+    return task_type, task_key
+
+def task_process_data(request, data):
+    course_key = CourseKey.from_string(data['course'])
+    task_type, task_key = get_task_type_and_key(data)
     task_class = process_data
     task_input = {'data': data }
-    task_key = "EOL_Xblock_Completion_{}".format(data['course'])
 
     return submit_task(
         request,
@@ -76,34 +111,498 @@ def generate(_xmodule_instance_args, _entry_id, course_id, task_input, action_na
     #filter_types = ['problem']
 
     report_store = ReportStore.from_config('GRADES_DOWNLOAD')
-    csv_name = 'Reporte_de_Preguntas'
-    if data['format']:
-        csv_name = 'Reporte_de_Preguntas_Resumen'
+    report_name = _get_report_name(course_id, data, start_date)
+    # the fingerprint is computed before reading the student states, later changes make a new report
+    fingerprint = XblockCompletionView().get_report_fingerprint(data)
+    shards = None
+    if data.get('output', 'csv') == 'csv' and _get_shard_queue() is not None:
+        # the parts of the other outputs can not be concatenated
+        shards = XblockCompletionView().get_report_shards(data)
+    if shards is not None:
+        return _generate_sharded(task_progress, course_id, data, report_store, report_name, shards, fingerprint)
+    checkpoint_blocks = getattr(settings, 'XBLOCKCOMPLETION_CHECKPOINT_BLOCKS', 100)
+    if (data.get('output', 'csv') == 'csv' and checkpoint_blocks > 0 and hasattr(report_store, 'storage')
+            and getattr(settings, 'XBLOCKCOMPLETION_CHECKPOINT_TTL', 86400) > 0):
+        parts = XblockCompletionView().get_report_shards(data, checkpoint_blocks)
+        if parts is not None:
+            return _generate_checkpointed(task_progress, course_id, data, report_store, report_name, parts, fingerprint)
 
-    report_name = u"{course_prefix}_{csv_name}_{timestamp_str}.csv".format(
-        course_prefix=course_filename_prefix_generator(course_id),
-        csv_name=csv_name,
-        timestamp_str=start_date.strftime("%Y-%m-%d-%H%M")
-    )
-    output_buffer = ContentFile('')
-    if six.PY2:
-        output_buffer.write(codecs.BOM_UTF8)
-    csvwriter = csv.writer(output_buffer, delimiter=';', quoting=csv.QUOTE_ALL)
+    output_buffer = _get_output_buffer()
+    report_writer = _get_report_writer(data.get('output', 'csv'), output_buffer)
 
-    csvwriter = XblockCompletionView()._build_student_data(data, csvwriter)
+    view = XblockCompletionView()
+    view.stats = ReportStats(task_progress)
+    view._build_student_data(data, report_writer)
+    with view.stats.timer('csv'):
+        report_writer.close()
+    view.stats.log_failed_blocks(course_id)
+    task_progress.total = view.stats.blocks_total
+    task_progress.attempted = task_progress.succeeded = view.stats.blocks_processed
 
     current_step = {'step': 'XblockCompletion - Uploading CSV'}
+    current_step.update(view.stats.get_meta())
     task_progress.update_task_state(extra_meta=current_step)
 
+    with view.stats.timer('upload'):
+        _store_report(report_store, course_id, report_name, output_buffer)
+    output_buffer.close()
+    XblockCompletionReport.objects.create(course_id=course_id, fingerprint=fingerprint, report_name=report_name)
+    current_step = {
+        'step': 'XblockCompletion - CSV uploaded',
+        'report_name': report_name,
+        'timing': view.stats.get_timing(),
+    }
+    current_step.update(view.stats.get_meta())
+    logger.info("XblockCompletion - Report generated, course: {}, report: {}, rows: {}, timing: {}".format(
+        course_id, report_name, view.stats.rows, current_step['timing']))
+
+    return task_progress.update_task_state(extra_meta=current_step)
+
+@task(queue='edx.lms.core.low')
+def process_data_shard(data, block_ids, part_path):
+    """
+    Generate the rows (without header) of the blocks of a shard of a report
+    and save them in `part_path` of the `ReportStore` storage, return the saved
+    path and the blocks with errors in their capa problem
+    """
+    report_store = ReportStore.from_config('GRADES_DOWNLOAD')
+    output_buffer = _get_output_buffer()
+    csvwriter = _get_csvwriter(output_buffer)
+    view = XblockCompletionView()
+    view._build_student_data(
+        data, csvwriter, block_keys=[UsageKey.from_string(x) for x in block_ids], write_header=False)
+    view.stats.log_failed_blocks(data['course'])
     output_buffer.seek(0)
-    report_store.store(course_id, report_name, output_buffer)
+    part_path = report_store.storage.save(part_path, File(output_buffer))
+    output_buffer.close()
+    return part_path, list(view.stats.failed_blocks)
+
+def _get_shard_queue():
+    """
+    Return the queue of the process_data_shard subtasks, or None if it is the queue of
+    process_data: the parent task waits for its shards, with the same queue all the
+    workers could be waiting and no shard would ever run
+    """
+    shard_queue = getattr(settings, 'XBLOCKCOMPLETION_SHARD_QUEUE', 'edx.lms.core.xblockcompletion_shards')
+    if shard_queue == process_data.queue:
+        logger.warning("XblockCompletion - The shard queue is the queue of the report task, the report is not sharded, queue: {}".format(shard_queue))
+        return None
+    return shard_queue
+
+def _generate_sharded(task_progress, course_id, data, report_store, report_name, shards, fingerprint):
+    """
+    Generate the report splitting its blocks in `shards`, each shard is generated by a
+    process_data_shard subtask and the parts are merged in order in the final report.
+    The shards completed are saved in the checkpoint of the report, a retried task
+    only submits the missing shards
+    """
+    checkpoint = _get_report_checkpoint(report_store, course_id, data, fingerprint)
+    if checkpoint is not None:
+        parts_dir = checkpoint.parts_dir
+    else:
+        parts_dir = 'xblockcompletion_parts_{}'.format(uuid.uuid4().hex)
+    part_paths = [
+        report_store.path_to(course_id, '{}/part_{:05d}.csv'.format(parts_dir, i))
+        for i in range(len(shards))
+    ]
+    # the parts of another partition of the blocks (e.g. other XBLOCKCOMPLETION_SHARD_BLOCKS) are generated again
+    pending = [i for i in range(len(shards)) if checkpoint is None or checkpoint.get_part(i, shards[i]) is None]
+    task_progress.total = len(shards)
+    shard_queue = _get_shard_queue()
+    poll_interval = getattr(settings, 'XBLOCKCOMPLETION_SHARD_POLL_INTERVAL', 5)
+    completed = False
+    try:
+        results = {}
+        if pending:
+            result = group(
+                process_data_shard.s(data, shards[i], part_paths[i]).set(queue=shard_queue)
+                for i in pending
+            ).apply_async()
+            while not result.ready():
+                if checkpoint is not None:
+                    for i, shard_result in zip(pending, result.results):
+                        if shard_result.successful() and checkpoint.get_part(i, shards[i]) is None:
+                            checkpoint.add_part(i, shards[i], *shard_result.result)
+                task_progress.attempted = task_progress.succeeded = len(shards) - len(pending) + result.completed_count()
+                task_progress.update_task_state(extra_meta={
+                    'step': 'XblockCompletion - Calculating students answers to problem',
+                    'shards_completed': task_progress.succeeded,
+                    'shards_total': len(shards),
+                })
+                sleep(poll_interval)
+            results = dict(zip(pending, result.get(disable_sync_subtasks=False)))
+        if checkpoint is not None:
+            for i in range(len(shards)):
+                part = checkpoint.get_part(i, shards[i])
+                if part is not None:
+                    results[i] = (part['path'], part['failed_blocks'])
+        part_paths = [results[i][0] for i in range(len(shards))]
+        failed_blocks = [block_id for i in range(len(shards)) for block_id in results[i][1]]
+        task_progress.attempted = task_progress.succeeded = len(shards)
+        current_step = {'step': 'XblockCompletion - Merging CSV parts', 'shards_total': len(shards)}
+        task_progress.update_task_state(extra_meta=current_step)
+        _merge_report_parts(report_store, course_id, report_name, data, part_paths)
+        # the parts resumed from the checkpoint have the student states of its first task
+        XblockCompletionReport.objects.create(
+            course_id=course_id, fingerprint=checkpoint.fingerprint if checkpoint is not None else fingerprint, report_name=report_name)
+        completed = True
+    finally:
+        # the parts of a checkpoint are kept to resume the report
+        if checkpoint is not None and completed:
+            checkpoint.delete()
+        elif checkpoint is None:
+            for part_path in part_paths:
+                if report_store.storage.exists(part_path):
+                    report_store.storage.delete(part_path)
     current_step = {
         'step': 'XblockCompletion - CSV uploaded',
         'report_name': report_name,
+        'shards_total': len(shards),
+        'failed_blocks': failed_blocks,
     }
+    return task_progress.update_task_state(extra_meta=current_step)
 
+def _generate_checkpointed(task_progress, course_id, data, report_store, report_name, parts, fingerprint):
+    """
+    Generate the report by `parts` of blocks saved in the ReportStore storage, after each part
+    the checkpoint of the report is updated. A retried or resubmitted task with the same task
+    key skips the parts already generated and reuses their identity map
+    """
+    checkpoint = _get_report_checkpoint(report_store, course_id, data, fingerprint)
+    view = XblockCompletionView()
+    view.stats = ReportStats(task_progress)
+    view.stats.report_blocks = sum(len(x) for x in parts)
+    view.doc_ids.update(checkpoint.get_doc_ids())
+    task_progress.total = view.stats.report_blocks
+    for i, blocks in enumerate(parts):
+        # the progress of the blocks of the part is added to the blocks of the previous parts
+        view.stats.blocks_offset = sum(len(x) for x in parts[:i])
+        view.stats.blocks_processed = 0
+        # the parts of another partition of the blocks (e.g. other XBLOCKCOMPLETION_CHECKPOINT_BLOCKS) are generated again
+        if checkpoint.get_part(i, blocks) is not None:
+            view.stats.blocks_resumed += len(blocks)
+        else:
+            failed_before = set(view.stats.failed_blocks)
+            output_buffer = _get_output_buffer()
+            view._build_student_data(
+                data, _get_csvwriter(output_buffer), block_keys=[UsageKey.from_string(x) for x in blocks], write_header=False)
+            output_buffer.seek(0)
+            part_path = report_store.storage.save(
+                report_store.path_to(course_id, '{}/part_{:05d}.csv'.format(checkpoint.parts_dir, i)), File(output_buffer))
+            output_buffer.close()
+            failed_blocks = [x for x in view.stats.failed_blocks if x not in failed_before]
+            checkpoint.add_part(i, blocks, part_path, failed_blocks, view.doc_ids)
+        view.stats.blocks_processed = len(blocks)
+        task_progress.attempted = task_progress.succeeded = view.stats.blocks_offset + len(blocks)
+        current_step = {
+            'step': 'XblockCompletion - Calculating students answers to problem',
+            'parts_completed': i + 1,
+            'parts_total': len(parts),
+        }
+        current_step.update(view.stats.get_meta())
+        task_progress.update_task_state(extra_meta=current_step)
+    view.stats.log_failed_blocks(course_id)
+    current_step = {'step': 'XblockCompletion - Merging CSV parts', 'parts_total': len(parts)}
+    task_progress.update_task_state(extra_meta=current_step)
+    with view.stats.timer('upload'):
+        _merge_report_parts(report_store, course_id, report_name, data, [checkpoint.get_part(i, blocks)['path'] for i, blocks in enumerate(parts)])
+    # the parts resumed from the checkpoint have the student states of its first task
+    XblockCompletionReport.objects.create(course_id=course_id, fingerprint=checkpoint.fingerprint, report_name=report_name)
+    checkpoint.delete()
+    view.stats.blocks_offset = 0
+    view.stats.report_blocks = None
+    view.stats.blocks_total = view.stats.blocks_processed = sum(len(x) for x in parts)
+    current_step = {
+        'step': 'XblockCompletion - CSV uploaded',
+        'report_name': report_name,
+        'parts_total': len(parts),
+        'timing': view.stats.get_timing(),
+    }
+    current_step.update(view.stats.get_meta())
+    current_step['failed_blocks'] = [block_id for x in checkpoint.parts for block_id in x['failed_blocks']]
+    logger.info("XblockCompletion - Report generated, course: {}, report: {}, rows: {}, timing: {}".format(
+        course_id, report_name, view.stats.rows, current_step['timing']))
     return task_progress.update_task_state(extra_meta=current_step)
 
+def _merge_report_parts(report_store, course_id, report_name, data, part_paths):
+    """
+    Store the report with the header and the csv parts in `part_paths`
+    """
+    output_buffer = _get_output_buffer()
+    if six.PY2:
+        output_buffer.write(codecs.BOM_UTF8)
+    csvwriter = _get_csvwriter(output_buffer)
+    csvwriter.writerow(_get_utf8_encoded_rows(XblockCompletionView().get_header(data['format'], data.get('distribution'))))
+    for part_path in part_paths:
+        with report_store.storage.open(part_path) as part_file:
+            shutil.copyfileobj(part_file, output_buffer)
+    _store_report(report_store, course_id, report_name, output_buffer)
+    output_buffer.close()
+
+def _get_report_checkpoint(report_store, course_id, data, fingerprint):
+    """
+    Return the checkpoint of the report task of `data`, or None if the checkpoints are disabled.
+    `fingerprint` is the fingerprint of the report when the checkpoint is created
+    """
+    if getattr(settings, 'XBLOCKCOMPLETION_CHECKPOINT_TTL', 86400) <= 0 or not hasattr(report_store, 'storage'):
+        return None
+    task_type, task_key = get_task_type_and_key(data)
+    store = modulestore()
+    with store.bulk_operations(course_id):
+        content_version = XblockCompletionView().get_course_version(course_id, store)
+    return ReportCheckpoint(report_store, course_id, '{}|{}'.format(task_type, task_key), content_version, fingerprint)
+
+def _get_report_name(course_id, data, start_date):
+    """
+    Return the file name of the report
+    """
+    csv_name = 'Reporte_de_Preguntas'
+    if data['format']:
+        csv_name = 'Reporte_de_Preguntas_Resumen'
+    elif data.get('distribution'):
+        csv_name = 'Reporte_de_Preguntas_Distribucion'
+
+    return u"{course_prefix}_{csv_name}_{timestamp_str}.{extension}".format(
+        course_prefix=course_filename_prefix_generator(course_id),
+        csv_name=csv_name,
+        timestamp_str=start_date.strftime("%Y-%m-%d-%H%M"),
+        extension=data.get('output', 'csv')
+    )
+
+# last row of a streaming report that failed while it was streamed, checked by xblockcompletion.js
+STREAM_ERROR_MARKER = '#XBLOCKCOMPLETION_ERROR'
+
+class Echo(object):
+    """
+        File-like object that returns the value written, used to stream the csv
+    """
+    def write(self, value):
+        return value
+
+def _get_output_buffer():
+    """
+    Return the buffer of a report, rows are written to memory until
+    XBLOCKCOMPLETION_SPOOL_MAX_SIZE bytes and then to disk
+    """
+    return tempfile.SpooledTemporaryFile(max_size=getattr(settings, 'XBLOCKCOMPLETION_SPOOL_MAX_SIZE', 5 * 1024 * 1024))
+
+def _get_csvwriter(output_buffer):
+    """
+    Return the csv writer of the report, encoding the rows as utf-8
+    """
+    if six.PY2:
+        return csv.writer(output_buffer, delimiter=';', quoting=csv.QUOTE_ALL)
+    return csv.writer(codecs.getwriter('utf-8')(output_buffer), delimiter=';', quoting=csv.QUOTE_ALL)
+
+def _get_report_writer(output, output_buffer):
+    """
+    Return the writer of the report rows in the `output` format, 'csv', 'csv.gz',
+    'parquet' or 'xlsx', the writer must be closed after the last row
+    """
+    if output == 'parquet':
+        return ParquetReportWriter(output_buffer)
+    if output == 'xlsx':
+        return XlsxReportWriter(output_buffer)
+    return CsvReportWriter(output_buffer, compress=output == 'csv.gz')
+
+def _get_available_outputs():
+    """
+    Return the outputs whose libraries are installed
+    """
+    outputs = ['csv', 'csv.gz']
+    for output, module in (('parquet', 'pyarrow'), ('xlsx', 'openpyxl')):
+        try:
+            __import__(module)
+            outputs.append(output)
+        except ImportError:
+            pass
+    return outputs
+
+class CsvReportWriter(object):
+    """
+        `;`-delimited csv report, gzip compressed if compress is True
+    """
+    def __init__(self, output_buffer, compress=False):
+        self.gzip_file = None
+        if compress:
+            self.gzip_file = output_buffer = gzip.GzipFile(fileobj=output_buffer, mode='wb')
+        if six.PY2:
+            output_buffer.write(codecs.BOM_UTF8)
+        self.csvwriter = _get_csvwriter(output_buffer)
+
+    def writerow(self, row):
+        return self.csvwriter.writerow(row)
+
+    def close(self):
+        # the output buffer is not closed
+        if self.gzip_file is not None:
+            self.gzip_file.close()
+
+class ParquetReportWriter(object):
+    """
+        Parquet report, the first row is the header. The attempts, points and counts are
+        numeric columns (empty values are null), the text columns repeated between the
+        students (section, unit, question texts...) have dictionary encoding, so they
+        are stored once by row group of XBLOCKCOMPLETION_CHUNK_SIZE rows
+    """
+    # header -> python type of the numeric columns
+    NUMERIC_COLUMNS = {
+        'Intentos': int,
+        'Pts Ganados': float,
+        'Pts Posibles': float,
+        'Pts Total Componente': float,
+        'Estudiantes': int,
+        'Porcentaje': float,
+        'Porcentaje Correctas': float,
+        'Intentos Promedio': float,
+    }
+    # text columns with a different value by student, without dictionary encoding
+    UNIQUE_COLUMNS = ('Username', 'Email', 'Run', 'State')
+
+    def __init__(self, output_buffer):
+        self.output_buffer = output_buffer
+        self.header = None
+        self.rows = []
+        self.writer = None
+
+    def writerow(self, row):
+        if self.header is None:
+            self.header = list(row)
+            return
+        # optional trailing columns (e.g. has saved answers) are empty
+        row = list(row[:len(self.header)])
+        self.rows.append(row + [None] * (len(self.header) - len(row)))
+        if len(self.rows) >= getattr(settings, 'XBLOCKCOMPLETION_CHUNK_SIZE', 2000):
+            self.flush()
+
+    def get_array(self, name, column):
+        import pyarrow as pa
+        column_type = self.NUMERIC_COLUMNS.get(name)
+        if column_type is None:
+            return pa.array([six.text_type(x) if x is not None else '' for x in column], type=pa.string())
+        return pa.array(
+            [column_type(x) if x is not None and x != '' else None for x in column],
+            type=pa.int64() if column_type is int else pa.float64())
+
+    def flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        columns = list(zip(*self.rows)) or [[] for __ in self.header]
+        table = pa.Table.from_arrays([self.get_array(name, column) for name, column in zip(self.header, columns)], names=self.header)
+        if self.writer is None:
+            dictionary_columns = [x for x in self.header if x not in self.NUMERIC_COLUMNS and x not in self.UNIQUE_COLUMNS]
+            self.writer = pq.ParquetWriter(self.output_buffer, table.schema, use_dictionary=dictionary_columns, compression='snappy')
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        if self.header is None:
+            return
+        if self.rows or self.writer is None:
+            self.flush()
+        self.writer.close()
+
+class XlsxReportWriter(object):
+    """
+        Excel report written in openpyxl write only mode, the rows are not kept in memory.
+        A new sheet (with the header) is started when a sheet is full
+    """
+    MAX_ROWS = 1048576
+    MAX_CELL_LENGTH = 32767
+
+    def __init__(self, output_buffer):
+        from openpyxl import Workbook
+        self.output_buffer = output_buffer
+        self.workbook = Workbook(write_only=True)
+        self.worksheet = None
+        self.header = None
+        self.sheet_rows = 0
+
+    def writerow(self, row):
+        from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+        row = [
+            ILLEGAL_CHARACTERS_RE.sub('', x)[:self.MAX_CELL_LENGTH] if isinstance(x, six.string_types) else x
+            for x in row
+        ]
+        if self.header is None:
+            self.header = row
+        if self.worksheet is None or self.sheet_rows >= self.MAX_ROWS:
+            self.worksheet = self.workbook.create_sheet('Reporte {}'.format(len(self.workbook.worksheets) + 1))
+            self.sheet_rows = 0
+            if row is not self.header:
+                self.worksheet.append(self.header)
+                self.sheet_rows += 1
+        self.worksheet.append(row)
+        self.sheet_rows += 1
+
+    def close(self):
+        if self.worksheet is None:
+            self.workbook.create_sheet('Reporte 1')
+        self.workbook.save(self.output_buffer)
+
+# fields of the student state read by the resumen report, in json a key can not
+# be written inside a string without escaping its quotes
+STATE_ATTEMPTS_RE = re.compile(r'"attempts"\s*:\s*(\d+)')
+STATE_CORRECT_MAP_RE = re.compile(r'"correct_map"\s*:\s*')
+STATE_HAS_SAVED_ANSWERS_RE = re.compile(r'"has_saved_answers"\s*:\s*true')
+
+def _get_state_correct_map_size(state):
+    """
+    Return the number of answers of the correct_map of a json student state decoding
+    only the map, 0 if it is not an object or None if the state has no correct_map
+    """
+    match = STATE_CORRECT_MAP_RE.search(state)
+    if match is None:
+        return None
+    try:
+        correct_map = json.JSONDecoder().raw_decode(state, match.end())[0]
+    except ValueError:
+        return None
+    return len(correct_map) if isinstance(correct_map, dict) else 0
+
+def _store_report(report_store, course_id, report_name, output_buffer):
+    """
+    Upload `output_buffer` to the `ReportStore` storage in chunks, ReportStore.store
+    reads the whole file in memory. Storages with multipart support (e.g. S3) upload
+    the file in parts.
+    """
+    output_buffer.seek(0)
+    if hasattr(report_store, 'storage'):
+        report_store.storage.save(report_store.path_to(course_id, report_name), File(output_buffer))
+    else:
+        report_store.store(course_id, report_name, output_buffer)
+
+def _init_process_worker():
+    """
+    Close the database connections inherited from the parent process
+    """
+    from django.db import connections
+    connections.close_all()
+
+def _build_block_rows(course_id, block_id, block_outline, student_states, is_resumen, block_item=None):
+    """
+    Return the report rows of a problem block and its capa errors, used by the workers
+    of the report pool. Process workers do not receive the block, it is read from the modulestore
+    """
+    block_key = UsageKey.from_string(block_id)
+    if block_item is None:
+        store = modulestore()
+        with store.bulk_operations(CourseKey.from_string(course_id)):
+            try:
+                block_item = ReportBlock.from_xblock(store.get_item(block_key))
+            except Exception as e:
+                # the block is added to the failed blocks of the report, its students have no rows
+                logger.exception("XblockCompletion - Error to read the block in the worker, course: {}, block id: {}".format(course_id, block_id))
+                return [], {block_id: [len(student_states), str(e)]}
+    view = XblockCompletionView()
+    try:
+        rows = list(view.get_block_rows(block_key, block_item, block_outline, student_states, is_resumen))
+    finally:
+        if threading.current_thread() is not threading.main_thread():
+            # the connections opened by a thread worker (e.g. get_resumen_state) are not reused
+            connections.close_all()
+    return rows, view.stats.failed_blocks
+
 def _get_utf8_encoded_rows(row):
     """
     Given a list of `rows` containing unicode strings, return a
@@ -116,10 +615,396 @@ def _get_utf8_encoded_rows(row):
     else:
         return [six.text_type(item) for item in row]
 
+class ReportCheckpoint(object):
+    """
+        Checkpoint of a report task saved in XblockCompletionCheckpoint, it is dropped with
+        its parts after XBLOCKCOMPLETION_CHECKPOINT_TTL seconds without changes or when the
+        course content changes. The fingerprint of the report is the one of the task that
+        created the checkpoint, the oldest student states of its parts
+    """
+    def __init__(self, report_store, course_key, checkpoint_id, content_version, fingerprint):
+        self.report_store = report_store
+        # the parts of a checkpoint are saved in the same directory between retries
+        self.parts_dir = 'xblockcompletion_parts_{}'.format(hashlib.md5(checkpoint_id.encode('utf-8')).hexdigest())
+        expiration = datetime.now(UTC) - timedelta(seconds=getattr(settings, 'XBLOCKCOMPLETION_CHECKPOINT_TTL', 86400))
+        for expired in XblockCompletionCheckpoint.objects.filter(course_id=course_key, modified__lt=expiration):
+            self.delete_parts(json.loads(expired.parts))
+            expired.delete()
+        self.checkpoint, created = XblockCompletionCheckpoint.objects.get_or_create(
+            checkpoint_id=checkpoint_id,
+            defaults={'course_id': course_key, 'content_version': content_version, 'fingerprint': fingerprint})
+        if not created and self.checkpoint.content_version != content_version:
+            logger.info("XblockCompletion - Checkpoint dropped, the course content changed, checkpoint: {}".format(checkpoint_id))
+            self.delete_parts(json.loads(self.checkpoint.parts))
+            self.checkpoint.parts = '[]'
+            self.checkpoint.doc_ids = '{}'
+            self.checkpoint.content_version = content_version
+            self.checkpoint.fingerprint = fingerprint
+            self.checkpoint.save()
+        elif self.checkpoint.parts == '[]' and self.checkpoint.fingerprint != fingerprint:
+            # no part was generated with the states of the previous task
+            self.checkpoint.fingerprint = fingerprint
+            self.checkpoint.save()
+        self.fingerprint = self.checkpoint.fingerprint
+        self.parts = json.loads(self.checkpoint.parts)
+        if self.parts:
+            logger.info("XblockCompletion - Report resumed, checkpoint: {}, parts: {}".format(checkpoint_id, len(self.parts)))
+
+    def get_part(self, key, blocks):
+        """
+            Return the part `key` if it was generated with the same blocks, or None
+        """
+        return next((x for x in self.parts if x['key'] == key and x['blocks'] == list(blocks)), None)
+
+    def get_doc_ids(self):
+        return {int(user_id): doc_id for user_id, doc_id in json.loads(self.checkpoint.doc_ids).items()}
+
+    def add_part(self, key, blocks, path, failed_blocks, doc_ids=None):
+        # a part of another partition of the blocks is replaced
+        replaced = [x for x in self.parts if x['key'] == key]
+        self.delete_parts([x for x in replaced if x['path'] != path])
+        self.parts = [x for x in self.parts if x['key'] != key]
+        self.parts.append({'key': key, 'blocks': blocks, 'path': path, 'failed_blocks': failed_blocks})
+        self.parts.sort(key=itemgetter('key'))
+        self.checkpoint.parts = json.dumps(self.parts)
+        if doc_ids is not None:
+            self.checkpoint.doc_ids = json.dumps(doc_ids)
+        self.checkpoint.save()
+
+    def delete(self):
+        self.delete_parts(self.parts)
+        self.checkpoint.delete()
+
+    def delete_parts(self, parts):
+        for part in parts:
+            if self.report_store.storage.exists(part['path']):
+                self.report_store.storage.delete(part['path'])
+
+class ReportBlock(object):
+    """
+        Fields of a problem block used by the report, read once from the modulestore
+    """
+    __slots__ = ('location', 'display_name', 'weight', 'data', 'parent', 'resources_fs', 'i18n')
+
+    def __init__(self, location, display_name, weight, data, parent, resources_fs, i18n):
+        self.location = location
+        self.display_name = display_name
+        self.weight = weight
+        self.data = data
+        self.parent = parent
+        self.resources_fs = resources_fs
+        self.i18n = i18n
+
+    @classmethod
+    def from_xblock(cls, block):
+        return cls(
+            location=block.location,
+            display_name=block.display_name,
+            weight=getattr(block, 'weight', None),
+            data=block.data,
+            parent=block.parent,
+            resources_fs=block.runtime.resources_fs,
+            i18n=block.runtime.service(block, "i18n"),
+        )
+
+class AnswerDistribution(object):
+    """
+        Aggregates of the answers of a problem block built one report at a time: the count
+        of each answer text, correctness and attempts of each question and the histogram of
+        the block scores of the students. Up to max_answers answer texts are counted by
+        question, the others are counted together
+    """
+    OTHER_ANSWERS = 'Otras respuestas'
+
+    def __init__(self, max_answers=100, buckets=10):
+        self.max_answers = max_answers
+        # answer_id -> question aggregates, in the order of the first answer
+        self.questions = OrderedDict()
+        self.histogram = [0] * buckets
+        self.student = None
+        self.student_score = None
+
+    def add(self, report):
+        """
+            Add a report of generate_report_data, the reports of a student must be consecutive
+        """
+        if report['username'] != self.student:
+            self.add_student_score()
+            self.student = report['username']
+            self.student_score = [0.0, report['total']]
+        self.student_score[0] += report['gained']
+        # the reports of the problems that can not be read have no questions
+        if not report['answer_id']:
+            return
+        question = self.questions.get(report['answer_id'])
+        if question is None:
+            question = self.questions[report['answer_id']] = {
+                'question': report['question'].replace("\n", ""),
+                'correct_answer': report['correct_answer'].replace("\n", ""),
+                'responses': 0,
+                'correct': 0,
+                'attempts': 0,
+                'answers': {},
+            }
+        question['responses'] += 1
+        question['correct'] += report['correct']
+        question['attempts'] += report['attempts'] or 0
+        answer = report['answer'].replace("\n", "")
+        if answer not in question['answers'] and len(question['answers']) >= self.max_answers:
+            answer = self.OTHER_ANSWERS
+        counts = question['answers'].setdefault(answer, [0, 0])
+        counts[0] += 1
+        counts[1] += report['correct']
+
+    def add_student_score(self):
+        if self.student_score is None:
+            return
+        gained, total = self.student_score
+        score = gained / total if total else 0
+        self.histogram[min(int(score * len(self.histogram)), len(self.histogram) - 1)] += 1
+        self.student_score = None
+
+    def get_rows(self):
+        """
+            Return the rows of the distribution: for each question a total row and a row by
+            answer text, most frequent first, then a row by score bucket of the block
+        """
+        self.add_student_score()
+        rows = []
+        for question in self.questions.values():
+            responses = question['responses']
+            rows.append([
+                question['question'],
+                question['correct_answer'],
+                'Total',
+                responses,
+                100.0,
+                round(100.0 * question['correct'] / responses, 2),
+                round(float(question['attempts']) / responses, 2),
+            ])
+            answers = sorted(question['answers'].items(), key=lambda x: (x[0] == self.OTHER_ANSWERS, -x[1][0]))
+            for answer, (count, correct) in answers:
+                rows.append([
+                    question['question'],
+                    question['correct_answer'],
+                    answer,
+                    count,
+                    round(100.0 * count / responses, 2),
+                    round(100.0 * correct / count, 2),
+                    '',
+                ])
+        students = sum(self.histogram)
+        buckets = len(self.histogram)
+        for i, count in enumerate(self.histogram):
+            rows.append([
+                'Puntaje',
+                '',
+                '{}-{}%'.format(100 * i // buckets, 100 * (i + 1) // buckets),
+                count,
+                round(100.0 * count / students, 2) if students else 0.0,
+                '',
+                '',
+            ])
+        return rows
+
+class ReportStats(object):
+    """
+        Progress counters and time spent by stage of a report, the progress is
+        sent to the task every XBLOCKCOMPLETION_PROGRESS_INTERVAL seconds
+    """
+    STAGES = ('db_fetch', 'identity', 'modulestore', 'xml', 'csv', 'upload')
+
+    def __init__(self, task_progress=None):
+        self.task_progress = task_progress
+        self.start_time = time()
+        self.last_update = self.start_time
+        self.blocks_total = 0
+        self.blocks_processed = 0
+        # reports generated by parts: blocks of the previous parts, blocks resumed from a checkpoint and blocks of the report
+        self.blocks_offset = 0
+        self.blocks_resumed = 0
+        self.report_blocks = None
+        self.rows = 0
+        self.student_ids = set()
+        self.timing = {stage: 0.0 for stage in self.STAGES}
+        # blocks with errors in their capa problem, block id -> [responses, error]
+        self.failed_blocks = OrderedDict()
+
+    @contextmanager
+    def timer(self, stage):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.timing[stage] += perf_counter() - start
+
+    def timed_iter(self, stage, iterator):
+        """
+            Yield the items of iterator adding the time spent getting them to stage
+        """
+        iterator = iter(iterator)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.timing[stage] += perf_counter() - start
+                return
+            self.timing[stage] += perf_counter() - start
+            yield item
+
+    def block_processed(self, blocks_processed):
+        self.blocks_processed = blocks_processed
+        interval = getattr(settings, 'XBLOCKCOMPLETION_PROGRESS_INTERVAL', 5)
+        if self.task_progress is None or time() - self.last_update < interval:
+            return
+        self.last_update = time()
+        current_step = {'step': 'XblockCompletion - Calculating students answers to problem'}
+        current_step.update(self.get_meta())
+        self.task_progress.total = current_step['blocks_total']
+        self.task_progress.attempted = self.task_progress.succeeded = current_step['blocks_processed']
+        self.task_progress.update_task_state(extra_meta=current_step)
+
+    def block_failed(self, block_id, error, responses=1):
+        if block_id not in self.failed_blocks:
+            self.failed_blocks[block_id] = [0, error]
+        self.failed_blocks[block_id][0] += responses
+
+    def log_failed_blocks(self, course_id):
+        for block_id, (responses, error) in self.failed_blocks.items():
+            logger.error("XblockCompletion - Error to create xml problem, course: {}, block id: {}, responses: {}, error: {}".format(
+                course_id, block_id, responses, error))
+
+    def get_meta(self):
+        blocks_processed = self.blocks_offset + self.blocks_processed
+        blocks_total = self.blocks_total if self.report_blocks is None else self.report_blocks
+        eta = None
+        # the eta is estimated from the blocks generated by this task
+        if blocks_processed > self.blocks_resumed:
+            elapsed = time() - self.start_time
+            eta = int(elapsed / (blocks_processed - self.blocks_resumed) * (blocks_total - blocks_processed))
+        return {
+            'blocks_processed': blocks_processed,
+            'blocks_total': blocks_total,
+            'rows_written': self.rows,
+            'students_processed': len(self.student_ids),
+            'eta_seconds': eta,
+            'failed_blocks': list(self.failed_blocks),
+        }
+
+    def get_timing(self):
+        return {stage: round(seconds, 3) for stage, seconds in self.timing.items()}
+
+class CompiledProblem(object):
+    """
+        Capa problem of a block built once for a seed, the question label and the
+        correct answer of each answer_id are computed the first time they are requested,
+        the text of the student answers is cached by answer
+    """
+    def __init__(self, block, capa_system, seed):
+        from capa.capa_problem import LoncapaProblem
+        self.seed = seed
+        self.lcp = LoncapaProblem(
+            problem_text=block.data,
+            id=block.location.html_id(),
+            capa_system=capa_system,
+            # We choose to run without a fully initialized CapaModule
+            capa_module=None,
+            state={'seed': seed},
+            seed=seed,
+            # extract_tree=False allows us to work without a fully initialized CapaModule
+            # We'll still be able to find particular data in the XML when we need it
+            extract_tree=False,
+        )
+        self.questions = {}
+        self.correct_answers = {}
+        self.answers = {}
+
+    def question(self, answer_id):
+        if answer_id not in self.questions:
+            self.questions[answer_id] = self.lcp.find_question_label(answer_id)
+        return self.questions[answer_id]
+
+    def correct_answer(self, answer_id):
+        if answer_id not in self.correct_answers:
+            self.correct_answers[answer_id] = self.lcp.find_correct_answer_text(answer_id)
+        return self.correct_answers[answer_id]
+
+    def answer(self, answer_id, current_answer):
+        key = (answer_id, json.dumps(current_answer, sort_keys=True))
+        if key not in self.answers:
+            self.answers[key] = self.lcp.find_answer_text(answer_id, current_answer=current_answer)
+        return self.answers[key]
+
+class DocIdCache(object):
+    """
+        Cache of user id -> doc_id pairs shared between the tasks of a worker,
+        expired after XBLOCKCOMPLETION_DOC_ID_CACHE_TTL seconds and bounded to
+        XBLOCKCOMPLETION_DOC_ID_CACHE_SIZE users (least recently used are removed first)
+    """
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, user_ids):
+        ttl = getattr(settings, 'XBLOCKCOMPLETION_DOC_ID_CACHE_TTL', 0)
+        if not ttl:
+            return {}
+        now = time()
+        result = {}
+        with self._lock:
+            for user_id in user_ids:
+                item = self._data.get(user_id)
+                if item is None:
+                    continue
+                if now - item[1] > ttl:
+                    del self._data[user_id]
+                    continue
+                self._data.move_to_end(user_id)
+                result[user_id] = item[0]
+        return result
+
+    def set_many(self, doc_ids):
+        ttl = getattr(settings, 'XBLOCKCOMPLETION_DOC_ID_CACHE_TTL', 0)
+        size = getattr(settings, 'XBLOCKCOMPLETION_DOC_ID_CACHE_SIZE', 0)
+        if not ttl or not size:
+            return
+        now = time()
+        with self._lock:
+            for user_id, doc_id in doc_ids.items():
+                self._data[user_id] = (doc_id, now)
+                self._data.move_to_end(user_id)
+            while len(self._data) > size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+doc_id_cache = DocIdCache()
+
 class XblockCompletionView(View):
     """
         Return a csv with progress students
     """
+    def __init__(self, **kwargs):
+        super(XblockCompletionView, self).__init__(**kwargs)
+        # identity map of the report, user id -> doc_id
+        self.doc_ids = {}
+        # compiled problems of the report, (block_key, seed) -> CompiledProblem
+        self.compiled_problems = OrderedDict()
+        # problems that failed to compile in the report, (block_key, seed) -> error
+        self.failed_problems = {}
+        self.stats = ReportStats()
+        # ids of the students enrolled in the course of the report
+        self.enrolled_student_ids = None
+        # filters of the report, see validate_and_get_scope
+        self.scope = {}
+        # (course_key, outline, problem blocks) of the last course, reused by the parts of a report
+        self.course_blocks = None
+        # (course_key, database alias) of the report read queries, see get_db_alias
+        self.db_alias = None
+
     @transaction.non_atomic_requests
     def dispatch(self, args, **kwargs):
         return super(XblockCompletionView, self).dispatch(args, **kwargs)
@@ -136,6 +1021,12 @@ class XblockCompletionView(View):
             elif not self.have_permission(request.user, data['course']):
                 logger.error("XblockCompletion - Usuario no tiene rol para esta funcionalidad, user: {}, course: {}".format(request.user, request.GET.get('course', '')))
                 return JsonResponse({'error': 'Usuario no tiene rol para esta funcionalidad'})
+            if data['output'] is None:
+                logger.error("XblockCompletion - Parametro output incorrecto, user: {}, output: {}".format(request.user, request.GET.get('output', '')))
+                return JsonResponse({'error': 'Parametro output incorrecto'})
+            if data['scope'] is None:
+                logger.error("XblockCompletion - Parametros de filtro incorrectos, user: {}, params: {}".format(request.user, request.GET))
+                return JsonResponse({'error': 'Parametros de filtro incorrectos'})
             data['base_url'] = request.build_absolute_uri('')
             return self.get_context(request, data)
         else:
@@ -143,14 +1034,108 @@ class XblockCompletionView(View):
         raise Http404()
 
     def get_context(self, request, data):
+        course_key = CourseKey.from_string(data['course'])
+        self.scope = data.get('scope') or {}
+        if data.get('output', 'csv') == 'csv' and self.get_enrolled_students_count(course_key) < getattr(settings, 'XBLOCKCOMPLETION_LIMIT_STUDENTS', 1000):
+            return self.get_streaming_response(data)
+        success_status = 'El reporte de preguntas esta siendo creado, en un momento estará disponible para descargar.'
+        if getattr(settings, 'XBLOCKCOMPLETION_REUSE_REPORTS', True):
+            report_name = self.get_reusable_report(course_key, self.get_report_fingerprint(data))
+            if report_name is not None:
+                logger.info("XblockCompletion - Report reused, course: {}, report: {}".format(data['course'], report_name))
+                reused_status = 'El reporte de preguntas ya esta disponible para descargar, no hay cambios desde el ultimo reporte.'
+                return JsonResponse({"status": reused_status, "report_name": report_name})
         try:
             task = task_process_data(request, data)
-            success_status = 'El reporte de preguntas esta siendo creado, en un momento estará disponible para descargar.'
             return JsonResponse({"status": success_status, "task_id": task.task_id})
         except AlreadyRunningError:
+            task = self.get_running_task(course_key, data)
+            if task is not None:
+                # the same report is being generated
+                return JsonResponse({"status": success_status, "task_id": task.task_id})
             logger.error("XblockCompletion - Task Already Running Error, user: {}, data: {}".format(request.user, data))
             return JsonResponse({'error_task': 'AlreadyRunningError'})
 
+    def get_report_fingerprint(self, data):
+        """
+            Return the fingerprint of the report of data: course, format, scope, last StudentModule
+            change, StudentModule rows (count and sum of ids, so a deleted row changes it),
+            enrolled students and course content version
+        """
+        course_key = CourseKey.from_string(data['course'])
+        self.scope = data.get('scope') or {}
+        modules = StudentModule.objects.using(self.get_db_alias(course_key)).filter(
+            course_id=course_key,
+            module_type="problem"
+            ).aggregate(last_modified=Max('modified'), count=Count('id'), ids=Sum('id'))
+        last_modified = modules['last_modified']
+        students = hashlib.sha1(','.join(str(x) for x in self.get_enrolled_student_ids(course_key)).encode('utf-8')).hexdigest()
+        store = modulestore()
+        with store.bulk_operations(course_key):
+            content_version = self.get_course_version(course_key, store)
+        fingerprint = [
+            data['course'],
+            'distribucion' if data.get('distribution') else data['format'],
+            data.get('output', 'csv'),
+            self.scope,
+            last_modified.isoformat() if last_modified else None,
+            modules['count'],
+            modules['ids'],
+            students,
+            content_version,
+        ]
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_reusable_report(self, course_key, fingerprint):
+        """
+            Return the name of the last report with the fingerprint if it is still in the ReportStore
+        """
+        report = XblockCompletionReport.objects.filter(course_id=course_key, fingerprint=fingerprint).order_by('-created').first()
+        if report is None:
+            return None
+        report_store = ReportStore.from_config('GRADES_DOWNLOAD')
+        if hasattr(report_store, 'storage') and not report_store.storage.exists(report_store.path_to(course_key, report.report_name)):
+            return None
+        return report.report_name
+
+    def get_running_task(self, course_key, data):
+        """
+            Return the running task of the same report or None
+        """
+        task_type, task_key = get_task_type_and_key(data)
+        return InstructorTask.objects.filter(
+            course_id=course_key,
+            task_type=task_type,
+            task_key=task_key
+            ).exclude(task_state__in=READY_STATES).order_by('-id').first()
+
+    def get_streaming_response(self, data):
+        """
+            Return the csv report generated in the request, used in courses with less than
+            XBLOCKCOMPLETION_LIMIT_STUDENTS students instead of the report task
+        """
+        course_key = CourseKey.from_string(data['course'])
+        response = StreamingHttpResponse(
+            self.get_streaming_rows(data),
+            content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+            _get_report_name(course_key, data, datetime.now(UTC)))
+        logger.info("XblockCompletion - Streaming report, course: {}, format: {}".format(data['course'], data['format']))
+        return response
+
+    def get_streaming_rows(self, data):
+        """
+            Yield the csv lines of the streaming response. The headers are already sent when
+            a row fails, so the report ends with a STREAM_ERROR_MARKER row instead of the rest
+        """
+        csvwriter = csv.writer(Echo(), delimiter=';', quoting=csv.QUOTE_ALL)
+        try:
+            for row in self.get_report_rows(data):
+                yield csvwriter.writerow(row)
+        except Exception:
+            logger.exception("XblockCompletion - Error in the streaming report, course: {}, rows: {}".format(data['course'], self.stats.rows))
+            yield csvwriter.writerow([STREAM_ERROR_MARKER])
+
     def have_permission(self, user, course_id):
         """
             Verify if the user is instructor
@@ -185,9 +1170,77 @@ class XblockCompletionView(View):
             # valida si existe el curso
             if self.validate_course(request.GET.get("course", "")):
                 data['course'] = request.GET.get("course", "")
-        
+        # the distribution is aggregated from the answers of the full report
+        data['distribution'] = aux_resumen == 'distribucion'
+        if data['distribution']:
+            data['format'] = False
+        # csv, csv.gz, parquet or xlsx
+        data['output'] = request.GET.get('output', '') or 'csv'
+        if data['output'] not in _get_available_outputs():
+            data['output'] = None
+        data['scope'] = {}
+        if data['course'] is not None:
+            data['scope'] = self.validate_and_get_scope(request, CourseKey.from_string(data['course']))
         return data
 
+    def validate_and_get_scope(self, request, course_key):
+        """
+            Return the filters of the report, all optional:
+            section, subsection: block id of a section or subsection of the course
+            blocks: block ids (parameter block, repeatable), problems equal to or under one of them
+            cohort: id of a cohort of the course
+            users: usernames (parameter user, repeatable)
+            since: only the answers modified since this date (YYYY-MM-DD or ISO datetime, UTC)
+            Return None if a filter is wrong
+        """
+        scope = {}
+        try:
+            for name, block_type in (('section', 'chapter'), ('subsection', 'sequential')):
+                if request.GET.get(name, '') != '':
+                    block_key = self.validate_block(request.GET.get(name, ''), course_key)
+                    if block_key.block_type != block_type:
+                        return None
+                    scope[name] = str(block_key)
+            blocks = [x for x in request.GET.getlist('block') if x != '']
+            if blocks:
+                scope['blocks'] = [str(self.validate_block(x, course_key)) for x in blocks]
+            users = [x for x in request.GET.getlist('user') if x != '']
+            if users:
+                scope['users'] = users
+            if request.GET.get('cohort', '') != '':
+                cohort = int(request.GET.get('cohort', ''))
+                if not CourseUserGroup.objects.filter(id=cohort, course_id=course_key, group_type=CourseUserGroup.COHORT).exists():
+                    return None
+                scope['cohort'] = cohort
+            if request.GET.get('since', '') != '':
+                scope['since'] = self.validate_since(request.GET.get('since', '')).isoformat()
+        except (InvalidKeyError, ValueError):
+            return None
+        return scope
+
+    def validate_block(self, block_id, course_key):
+        """
+            Return the key of a block of the course
+        """
+        block_key = UsageKey.from_string(block_id)
+        if block_key.course_key != course_key:
+            raise ValueError("block {} not in course {}".format(block_id, course_key))
+        return block_key
+
+    def validate_since(self, since):
+        """
+            Return the UTC datetime of a date or datetime
+        """
+        value = parse_datetime(since)
+        if value is None:
+            value = parse_date(since)
+            if value is None:
+                raise ValueError("invalid date {}".format(since))
+            value = datetime(value.year, value.month, value.day)
+        if value.tzinfo is None:
+            value = UTC.localize(value)
+        return value
+
     def validate_course(self, id_curso):
         """
             Verify if course.id exists
@@ -195,150 +1248,843 @@ class XblockCompletionView(View):
         from openedx.core.djangoapps.content.course_overviews.models import CourseOverview
         try:
             aux = CourseKey.from_string(id_curso)
-            return CourseOverview.objects.filter(id=aux).exists()
+            return CourseOverview.objects.using(self.get_db_alias(aux)).filter(id=aux).exists()
         except InvalidKeyError:
             return False
 
-    def get_block_keys(self, course_key):
-        smdat = list(StudentModule.objects.filter(
-            course_id=course_key, 
+    def get_db_alias(self, course_key):
+        """
+            Return the database alias of the report read queries of the course, XBLOCKCOMPLETION_READ_DB
+            or the default database if the read database is more than XBLOCKCOMPLETION_READ_DB_MAX_LAG
+            seconds behind it. The alias is checked once per course
+        """
+        alias = getattr(settings, 'XBLOCKCOMPLETION_READ_DB', DEFAULT_DB_ALIAS)
+        if alias == DEFAULT_DB_ALIAS:
+            return alias
+        if self.db_alias is None or self.db_alias[0] != course_key:
+            lag = None
+            if alias not in settings.DATABASES:
+                logger.error("XblockCompletion - Read database does not exist, alias: {}".format(alias))
+            else:
+                try:
+                    lag = self.get_replica_lag(alias, course_key)
+                except DatabaseError as e:
+                    logger.error("XblockCompletion - Error to check the read database, alias: {}, error: {}".format(alias, str(e)))
+            if lag is None or lag > getattr(settings, 'XBLOCKCOMPLETION_READ_DB_MAX_LAG', 60):
+                logger.warning("XblockCompletion - Read database is behind, using the default database, alias: {}, course: {}, lag: {}".format(alias, str(course_key), lag))
+                alias = DEFAULT_DB_ALIAS
+            self.db_alias = (course_key, alias)
+        return self.db_alias[1]
+
+    def get_replica_lag(self, alias, course_key):
+        """
+            Return the seconds the last StudentModule change of the course in the alias
+            database is behind the default database, or None if the alias has no changes
+        """
+        def get_last_modified(using):
+            return StudentModule.objects.using(using).filter(
+                course_id=course_key,
+                module_type="problem"
+                ).aggregate(last_modified=Max('modified'))['last_modified']
+        primary_modified = get_last_modified(DEFAULT_DB_ALIAS)
+        if primary_modified is None:
+            return 0
+        replica_modified = get_last_modified(alias)
+        if replica_modified is None:
+            return None
+        return max((primary_modified - replica_modified).total_seconds(), 0)
+
+    def get_course_user_states(self, course_key, block_keys=None, modified_since=None, is_resumen=False, student_ids=None):
+        """
+            Yield (block_key, student_states) for every problem block of the course
+            with attempts, reading the StudentModule rows of each block by pages of
+            XBLOCKCOMPLETION_CHUNK_SIZE students sorted by student id.
+            If block_keys is given, only these blocks are read and yielded in the block_keys order.
+            If modified_since is given, only the rows modified since that date are read.
+            If student_ids is given, only the rows of these enrolled students are read.
+            student_states is a lazy iterator, it must be consumed before the next block
+        """
+        fields = ['module_state_key', 'student__id', 'student__username', 'student__email', 'grade', 'max_grade', 'modified']
+        db_alias = self.get_db_alias(course_key)
+        smdat = self.filter_enrolled_students(StudentModule.objects.using(db_alias).filter(
+            course_id=course_key,
             module_type="problem",
-            student__courseenrollment__mode="honor",
-            student__courseenrollment__is_active=1,
             state__contains="attempts"
-            ).values('module_state_key').distinct())
-        return [x['module_state_key'] for x in smdat]
+            ), course_key)
+        if is_resumen and getattr(settings, 'XBLOCKCOMPLETION_RESUMEN_DB_EXTRACT', False) and connections[db_alias].vendor == 'mysql':
+            # the database extracts the fields used by the resumen report, the state is not read
+            smdat = smdat.annotate(
+                state_attempts=RawSQL("JSON_EXTRACT(courseware_studentmodule.state, '$.attempts')", [], output_field=CharField()),
+                state_correct_map_size=RawSQL(
+                    "CASE WHEN JSON_TYPE(JSON_EXTRACT(courseware_studentmodule.state, '$.correct_map')) = 'OBJECT' "
+                    "THEN JSON_LENGTH(courseware_studentmodule.state, '$.correct_map') ELSE 0 END", [], output_field=IntegerField()),
+                state_has_saved_answers=RawSQL("JSON_EXTRACT(courseware_studentmodule.state, '$.has_saved_answers')", [], output_field=CharField()),
+            )
+            fields += ['state_attempts', 'state_correct_map_size', 'state_has_saved_answers']
+        else:
+            fields.append('state')
+        if modified_since is not None:
+            smdat = smdat.filter(modified__gte=modified_since)
+        if student_ids is not None:
+            smdat = smdat.filter(student_id__in=student_ids)
+        if block_keys is None:
+            block_keys = list(smdat.order_by('module_state_key').values_list('module_state_key', flat=True).distinct())
+        smdat = smdat.values(*fields)
+        for block_key in block_keys:
+            rows = self.iter_with_doc_ids(self.stats.timed_iter('db_fetch', self.iter_block_user_states(smdat.filter(module_state_key=block_key))))
+            first = next(rows, None)
+            if first is not None:
+                yield block_key, chain([first], rows)
+
+    def iter_block_user_states(self, smdat):
+        """
+            Yield the StudentModule rows of smdat (one block) sorted by student id, reading them
+            by pages of XBLOCKCOMPLETION_CHUNK_SIZE rows after the last student id read, so the
+            database driver never buffers the whole result set and no page scans the previous ones
+        """
+        chunk_size = getattr(settings, 'XBLOCKCOMPLETION_CHUNK_SIZE', 2000)
+        page_smdat = smdat
+        while True:
+            page = list(page_smdat.order_by('student__id')[:chunk_size])
+            for row in page:
+                yield row
+            if len(page) < chunk_size:
+                return
+            page_smdat = smdat.filter(student_id__gt=page[-1]['student__id'])
+
+    def get_enrollments(self, course_key):
+        """
+            Return the active enrollments of the course in one of the
+            XBLOCKCOMPLETION_ENROLLMENT_MODES, of the students of the report scope
+        """
+        db_alias = self.get_db_alias(course_key)
+        enrollments = CourseEnrollment.objects.using(db_alias).filter(
+            course_id=course_key,
+            mode__in=getattr(settings, 'XBLOCKCOMPLETION_ENROLLMENT_MODES', ['honor']),
+            is_active=True
+            )
+        if self.scope.get('users'):
+            enrollments = enrollments.filter(user__username__in=self.scope['users'])
+        if self.scope.get('cohort'):
+            enrollments = enrollments.filter(user_id__in=CohortMembership.objects.using(db_alias).filter(
+                course_user_group_id=self.scope['cohort']).values('user_id'))
+        return enrollments
+
+    def get_enrolled_students_count(self, course_key):
+        """
+            Return the number of students included in the reports of the course
+        """
+        return self.get_enrollments(course_key).count()
+
+    def get_enrolled_student_ids(self, course_key):
+        """
+            Return the sorted ids of the students with an active enrollment in the course
+            in one of the XBLOCKCOMPLETION_ENROLLMENT_MODES, resolved once per report
+        """
+        if self.enrolled_student_ids is None:
+            self.enrolled_student_ids = sorted(self.get_enrollments(course_key).values_list('user_id', flat=True))
+        return self.enrolled_student_ids
+
+    def filter_enrolled_students(self, smdat, course_key):
+        """
+            Filter the StudentModule rows of the enrolled students. Up to
+            XBLOCKCOMPLETION_STUDENTS_CHUNK_SIZE students the ids are sent in the query,
+            with more students an enrollment subquery is used instead of a long IN list
+        """
+        student_ids = self.get_enrolled_student_ids(course_key)
+        if len(student_ids) <= getattr(settings, 'XBLOCKCOMPLETION_STUDENTS_CHUNK_SIZE', 5000):
+            return smdat.filter(student_id__in=student_ids)
+        return smdat.filter(student_id__in=self.get_enrollments(course_key).values('user_id'))
 
     def get_user_states(self, course_key, block_key):
-        smdat = StudentModule.objects.filter(
-            course_id=course_key, 
+        smdat = self.filter_enrolled_students(StudentModule.objects.using(self.get_db_alias(course_key)).filter(
+            course_id=course_key,
             module_type="problem",
             module_state_key=block_key,
-            student__courseenrollment__mode="honor",
-            student__courseenrollment__is_active=1,
             state__contains="attempts"
-            ).values('student__id', 'student__username', 'student__email', 'state').distinct()
-        user_id_list = smdat.values_list('student__id', flat=True)
-        user_doc_id = get_user_id_doc_id_pairs(user_id_list)
-        if user_doc_id != []:
-            user_doc_id_dict = {id: doc_id for id, doc_id in user_doc_id}
-            for user in smdat:
-                user['doc_id'] = user_doc_id_dict.get(user['student__username'], '')
-        return list(smdat)
+            ), course_key).values('student__id', 'student__username', 'student__email', 'state')
+        chunk_size = getattr(settings, 'XBLOCKCOMPLETION_CHUNK_SIZE', 2000)
+        return self.iter_with_doc_ids(self.stats.timed_iter('db_fetch', smdat.iterator(chunk_size=chunk_size)))
+
+    def iter_with_doc_ids(self, student_states):
+        """
+            Yield the student states adding their doc_id, resolved in chunks of XBLOCKCOMPLETION_CHUNK_SIZE
+        """
+        chunk_size = getattr(settings, 'XBLOCKCOMPLETION_CHUNK_SIZE', 2000)
+        student_states = iter(student_states)
+        while True:
+            chunk = list(islice(student_states, chunk_size))
+            if not chunk:
+                return
+            self.set_doc_ids(chunk)
+            for user in chunk:
+                self.stats.student_ids.add(user['student__id'])
+                yield user
+
+    def set_doc_ids(self, student_states):
+        """
+            Add the doc_id of each student to the list of student states
+        """
+        self.resolve_doc_ids(set(x['student__id'] for x in student_states))
+        for user in student_states:
+            user['doc_id'] = self.doc_ids.get(user['student__id'], '')
 
-    def get_block_ancestors(self, xblock, store):
+    def resolve_doc_ids(self, user_ids):
         """
-        Returns information about the ancestors of an xblock.
+            Load in the identity map of the report the doc_id of the users not resolved yet,
+            first from the doc_id cache shared between tasks and then from uchileedxlogin
         """
-        ancestors = []
+        missing = [x for x in user_ids if x not in self.doc_ids]
+        if not missing:
+            return
+        self.doc_ids.update(doc_id_cache.get_many(missing))
+        missing = [x for x in missing if x not in self.doc_ids]
+        if not missing:
+            return
+        with self.stats.timer('identity'):
+            user_doc_id_dict = {id: doc_id for id, doc_id in get_user_id_doc_id_pairs(missing)}
+        # users without doc_id are saved too, so they are not requested again
+        doc_ids = {x: user_doc_id_dict.get(x, '') for x in missing}
+        self.doc_ids.update(doc_ids)
+        doc_id_cache.set_many(doc_ids)
 
-        def collect_ancestor_info(ancestor):
+    def get_course_outline(self, course_key, store):
+        """
+            Return an index of the problem blocks of the course in course order,
+            block_key -> {'section', 'subsection', 'unit', 'position', 'ancestors'},
+            built in one traversal of the course structure
+        """
+        with self.stats.timer('modulestore'):
+            blocks = {item.location: item for item in store.get_items(course_key)}
+        outline = OrderedDict()
+
+        def collect_problems(block, ancestors, ancestor_keys):
             """
-            Collect xblock info regarding the specified xblock and its ancestors.
+                Add the problems under block to the outline, ancestors are the display names
+                of the blocks between the course and block, ancestor_keys their ids
             """
-            if ancestor.location.block_type != 'course':
-                ancestors.append({'type': ancestor.location.block_type, 'display_name': ancestor.display_name})
-                collect_ancestor_info(store.get_item(ancestor.parent))
-        collect_ancestor_info(store.get_item(xblock.parent))
-        return ancestors
+            if block.location.block_type == 'problem':
+                # problems nested deeper than a unit (e.g. library content) keep the top three levels
+                names = ancestors + ['', '', '']
+                outline[block.location] = {
+                    'section': names[0],
+                    'subsection': names[1],
+                    'unit': names[2],
+                    'position': len(outline),
+                    'ancestors': ancestor_keys,
+                }
+                return
+            if block.location.block_type != 'course':
+                ancestors = ancestors + [block.display_name]
+                ancestor_keys = ancestor_keys + [str(block.location)]
+            for child_key in getattr(block, 'children', []):
+                child = blocks.get(child_key)
+                if child is not None:
+                    collect_problems(child, ancestors, ancestor_keys)
+        with self.stats.timer('modulestore'):
+            course = store.get_course(course_key)
+        if course is not None:
+            collect_problems(blocks.get(course.location, course), [], [])
+        return outline
+
+    def get_scope_outline(self, outline):
+        """
+            Return the blocks of the outline in the section, subsection and blocks of the report scope
+        """
+        filters = [set([self.scope[name]]) for name in ('section', 'subsection') if self.scope.get(name)]
+        if self.scope.get('blocks'):
+            filters.append(set(self.scope['blocks']))
+        if not filters:
+            return outline
+        return OrderedDict(
+            (block_key, block_outline) for block_key, block_outline in outline.items()
+            if all(x.intersection(block_outline['ancestors'] + [str(block_key)]) for x in filters)
+        )
+
+    def get_scope_since(self):
+        """
+            Return the since date of the report scope or None
+        """
+        if not self.scope.get('since'):
+            return None
+        return parse_datetime(self.scope['since'])
+
+    def get_header(self, is_resumen, is_distribution=False):
+        if is_distribution:
+            return ['Seccion', 'SubSeccion', 'Unidad', 'Titulo', 'block id', 'Pregunta', 'Resp. Correcta', 'Respuesta', 'Estudiantes', 'Porcentaje', 'Porcentaje Correctas', 'Intentos Promedio']
+        if is_resumen:
+            return ['Username', 'Email', 'Run', 'Seccion', 'SubSeccion', 'Unidad', 'Titulo', 'Intentos', 'Pts Ganados', 'Pts Posibles', 'block id', 'Has saved answers']
+        return ['Username', 'Email', 'Run', 'Seccion', 'SubSeccion', 'Unidad', 'Titulo', 'Pregunta', 'Respuesta Estudiante', 'Resp. Correcta', 'Intentos', 'Pts Ganados', 'Pts Posibles', 'Pts Total Componente', 'block id', 'Has saved answers', 'State']
 
-    def _build_student_data(self, data, csvwriter):
+    def get_report_shards(self, data, shard_blocks=None):
         """
-            Create list of list to make csv report
+            Return the block ids of the report split in shards of shard_blocks (by default
+            XBLOCKCOMPLETION_SHARD_BLOCKS) problems in course order, or None if the report
+            has only one shard
+        """
+        if shard_blocks is None:
+            shard_blocks = getattr(settings, 'XBLOCKCOMPLETION_SHARD_BLOCKS', 0)
+        if shard_blocks <= 0:
+            return None
+        course_key = CourseKey.from_string(data['course'])
+        self.scope = data.get('scope') or {}
+        store = modulestore()
+        with store.bulk_operations(course_key):
+            block_ids = [str(x) for x in self.get_scope_outline(self.get_course_outline(course_key, store))]
+        if len(block_ids) <= shard_blocks:
+            return None
+        return [block_ids[i:i + shard_blocks] for i in range(0, len(block_ids), shard_blocks)]
+
+    def _build_student_data(self, data, csvwriter, block_keys=None, write_header=True):
+        """
+            Create list of list to make csv report,
+            if block_keys is given only these blocks are included
         """
         url_base = data['base_url']
         course_id = data['course']
         is_resumen = data['format']
         course_key = CourseKey.from_string(course_id)
-        if is_resumen:
-            header = ['Username', 'Email', 'Run', 'Seccion', 'SubSeccion', 'Unidad', 'Titulo', 'Intentos', 'Pts Ganados', 'Pts Posibles', 'block id', 'Has saved answers']
-        else:
-            header = ['Username', 'Email', 'Run', 'Seccion', 'SubSeccion', 'Unidad', 'Titulo', 'Pregunta', 'Respuesta Estudiante', 'Resp. Correcta', 'Intentos', 'Pts Ganados', 'Pts Posibles', 'Pts Total Componente', 'block id', 'Has saved answers', 'State']
-        csvwriter.writerow(_get_utf8_encoded_rows(header))
+        self.scope = data.get('scope') or {}
+        if write_header:
+            csvwriter.writerow(_get_utf8_encoded_rows(self.get_header(is_resumen, data.get('distribution'))))
+        store = modulestore()
+        with store.bulk_operations(course_key):
+            outline, blocks = self.get_course_blocks(course_key, store)
+            outline = self.get_scope_outline(outline)
+            if block_keys is not None:
+                block_keys = set(block_keys)
+                outline = OrderedDict((k, v) for k, v in outline.items() if k in block_keys)
+            self.stats.blocks_total = len(outline)
+            if data.get('distribution'):
+                course_states = self.get_course_user_states(course_key, list(outline), modified_since=self.get_scope_since())
+                self.write_rows(csvwriter, self.get_distribution_rows(outline, blocks, course_states))
+                return csvwriter
+            if getattr(settings, 'XBLOCKCOMPLETION_MATERIALIZED_ANSWERS', False):
+                self.write_rows(csvwriter, self.get_materialized_rows(course_key, outline, blocks, is_resumen))
+                return csvwriter
+            # the saved rows of the incremental report include all the students and answers
+            students_scope = any(self.scope.get(x) for x in ('users', 'cohort', 'since'))
+            if getattr(settings, 'XBLOCKCOMPLETION_INCREMENTAL', False) and not students_scope:
+                self.write_rows_incremental(course_key, outline, blocks, is_resumen, csvwriter, store)
+                return csvwriter
+            course_states = self.get_course_user_states(
+                course_key, list(outline), modified_since=self.get_scope_since(), is_resumen=is_resumen)
+            workers = getattr(settings, 'XBLOCKCOMPLETION_PARALLEL_WORKERS', 0)
+            if workers > 0:
+                self.write_rows_parallel(course_key, outline, blocks, course_states, is_resumen, csvwriter, workers)
+                return csvwriter
+            queue_size = getattr(settings, 'XBLOCKCOMPLETION_PIPELINE_QUEUE_SIZE', 4)
+            if queue_size > 0:
+                self.write_rows_pipeline(outline, blocks, course_states, is_resumen, csvwriter, queue_size)
+                return csvwriter
+            self.write_rows(csvwriter, self.get_course_rows(outline, blocks, course_states, is_resumen))
+        return csvwriter
+
+    def get_report_rows(self, data):
+        """
+            Yield the header and the rows of the report, used by the streaming response
+        """
+        is_resumen = data['format']
+        course_key = CourseKey.from_string(data['course'])
+        self.scope = data.get('scope') or {}
+        yield _get_utf8_encoded_rows(self.get_header(is_resumen, data.get('distribution')))
         store = modulestore()
-        list_blocks = self.get_block_keys(course_key)
         with store.bulk_operations(course_key):
-            for block_key in list_blocks:
+            outline = self.get_scope_outline(self.get_course_outline(course_key, store))
+            self.stats.blocks_total = len(outline)
+            blocks = self.get_report_blocks(course_key, store, outline)
+            if data.get('distribution'):
+                course_states = self.get_course_user_states(course_key, list(outline), modified_since=self.get_scope_since())
+                rows = self.get_distribution_rows(outline, blocks, course_states)
+            elif getattr(settings, 'XBLOCKCOMPLETION_MATERIALIZED_ANSWERS', False):
+                rows = self.get_materialized_rows(course_key, outline, blocks, is_resumen)
+            else:
+                course_states = self.get_course_user_states(
+                    course_key, list(outline), modified_since=self.get_scope_since(), is_resumen=is_resumen)
+                rows = self.get_course_rows(outline, blocks, course_states, is_resumen)
+            for row in rows:
+                self.stats.rows += 1
+                yield row
+        self.stats.log_failed_blocks(course_key)
+
+    def get_course_rows(self, outline, blocks, course_states, is_resumen):
+        """
+            Yield the rows of the blocks of the outline in course order
+        """
+        # blocks without student states are skipped, the progress is their position in the outline
+        positions = {block_key: i for i, block_key in enumerate(outline)}
+        for block_key, student_states in course_states:
+            block_item = blocks.get(block_key)
+            if block_item is None:
+                continue
+            for row in self.get_block_rows(block_key, block_item, outline[block_key], student_states, is_resumen):
+                yield row
+            self.stats.block_processed(positions[block_key] + 1)
+        self.stats.blocks_processed = self.stats.blocks_total
+
+    def get_distribution_rows(self, outline, blocks, course_states):
+        """
+            Yield the answer distribution rows of the blocks of the outline in course order,
+            aggregated in one pass over the student states of each block, see AnswerDistribution
+        """
+        positions = {block_key: i for i, block_key in enumerate(outline)}
+        max_answers = getattr(settings, 'XBLOCKCOMPLETION_DISTRIBUTION_MAX_ANSWERS', 100)
+        buckets = getattr(settings, 'XBLOCKCOMPLETION_DISTRIBUTION_BUCKETS', 10)
+        for block_key, student_states in course_states:
+            block_item = blocks.get(block_key)
+            if block_item is None:
+                continue
+            distribution = AnswerDistribution(max_answers, buckets)
+            for report in self.generate_report_data(block_item, student_states):
+                if report is None:
+                    continue
+                distribution.add(report)
+            block_outline = outline[block_key]
+            display_name = block_item.display_name.replace("\n", "")
+            for row in distribution.get_rows():
+                yield [
+                    block_outline['section'],
+                    block_outline['subsection'],
+                    block_outline['unit'],
+                    display_name,
+                    str(block_key),
+                    ] + row
+            self.stats.block_processed(positions[block_key] + 1)
+        self.stats.blocks_processed = self.stats.blocks_total
+
+    def get_materialized_rows(self, course_key, outline, blocks, is_resumen):
+        """
+            Yield the rows of the blocks of the outline in course order, read from the
+            XblockCompletionAnswer table in one query by XBLOCKCOMPLETION_BLOCKS_CHUNK_SIZE blocks
+        """
+        answers = self.filter_enrolled_students(XblockCompletionAnswer.objects.using(self.get_db_alias(course_key)).filter(
+            course_id=course_key,
+            report_format='resumen' if is_resumen else 'all'
+            ), course_key)
+        if self.get_scope_since() is not None:
+            answers = answers.filter(modified__gte=self.get_scope_since())
+        answers = answers.values(
+            'block_id', 'student__id', 'student__username', 'student__email', 'answer_id', 'question', 'answer',
+            'correct_answer', 'attempts', 'gained', 'possible', 'total', 'has_saved_answers', 'state')
+        block_keys = list(outline)
+        positions = {block_key: i for i, block_key in enumerate(outline)}
+        chunk_size = getattr(settings, 'XBLOCKCOMPLETION_CHUNK_SIZE', 2000)
+        blocks_chunk_size = getattr(settings, 'XBLOCKCOMPLETION_BLOCKS_CHUNK_SIZE', 100)
+        for i in range(0, len(block_keys), blocks_chunk_size):
+            blocks_chunk = block_keys[i:i + blocks_chunk_size]
+            position = Case(
+                *[When(block_id=block_key, then=Value(j)) for j, block_key in enumerate(blocks_chunk)],
+                output_field=IntegerField())
+            chunk_answers = answers.filter(block_id__in=blocks_chunk).annotate(block_position=position).order_by(
+                'block_position', 'student__id', 'position')
+            rows = self.iter_with_doc_ids(self.stats.timed_iter('db_fetch', chunk_answers.iterator(chunk_size=chunk_size)))
+            for block_key, block_answers in groupby(rows, key=itemgetter('block_id')):
+                block_item = blocks.get(block_key)
+                if block_item is None:
+                    continue
+                display_name = block_item.display_name.replace("\n", "")
+                for answer in block_answers:
+                    if is_resumen:
+                        yield self.get_resumen_row(block_key, display_name, outline[block_key], answer, answer)
+                    else:
+                        answer.update(username=answer['student__username'], email=answer['student__email'])
+                        yield self.get_full_row(block_key, display_name, outline[block_key], answer)
+                self.stats.block_processed(positions[block_key] + 1)
+        self.stats.blocks_processed = self.stats.blocks_total
+
+    def get_course_blocks(self, course_key, store):
+        """
+            Return the outline and the problem blocks of the course, read once for all the parts of a report
+        """
+        if self.course_blocks is None or self.course_blocks[0] != course_key:
+            outline = self.get_course_outline(course_key, store)
+            self.course_blocks = (course_key, outline, self.get_report_blocks(course_key, store, outline))
+        return self.course_blocks[1], self.course_blocks[2]
+
+    def get_report_blocks(self, course_key, store, outline):
+        """
+            Return the table of the problem blocks of the outline, block_key -> ReportBlock,
+            loaded with their definitions in one modulestore query
+        """
+        blocks = {}
+        with self.stats.timer('modulestore'):
+            # lazy=False loads the definitions (block.data) of all the problems in bulk
+            items = store.get_items(course_key, qualifiers={'category': 'problem'}, lazy=False)
+            for item in items:
+                if item.location not in outline:
+                    continue
                 try:
-                    block_item = store.get_item(block_key)
+                    blocks[item.location] = ReportBlock.from_xblock(item)
                 except Exception as e:
+                    logger.error("XblockCompletion - Error to read problem block, block id: {}, error: {}".format(str(item.location), str(e)))
+        return blocks
+
+    def write_rows(self, csvwriter, rows):
+        for row in rows:
+            with self.stats.timer('csv'):
+                csvwriter.writerow(row)
+            self.stats.rows += 1
+
+    def get_course_version(self, course_key, store):
+        """
+            Return the version of the published content of the course
+        """
+        course = store.get_course(course_key)
+        if course is None:
+            return ''
+        return str(getattr(course, 'course_version', None) or getattr(course, 'subtree_edited_on', None) or '')
+
+    def write_rows_incremental(self, course_key, outline, blocks, is_resumen, csvwriter, store):
+        """
+            Write the rows of each block reusing the rows saved in XblockCompletionBlockReport,
+            only the student states modified since the block watermark (minus
+            XBLOCKCOMPLETION_INCREMENTAL_OVERLAP seconds, for the transactions committed
+            late) are processed again. The saved students of a block are compared with its
+            enrolled student states, the missing students (e.g. enrolled after the watermark)
+            are read without the watermark and the deleted states are removed.
+            The saved rows are dropped when the course content version changes
+        """
+        report_format = 'resumen' if is_resumen else 'all'
+        content_version = self.get_course_version(course_key, store)
+        overlap = timedelta(seconds=getattr(settings, 'XBLOCKCOMPLETION_INCREMENTAL_OVERLAP', 300))
+        block_reports = XblockCompletionBlockReport.objects.filter(course_id=course_key, report_format=report_format)
+        block_reports.exclude(content_version=content_version).delete()
+        watermarks = dict(block_reports.values_list('block_id', 'watermark'))
+        modified_since = None
+        if outline and all(watermarks.get(block_key) for block_key in outline):
+            modified_since = min(watermarks[block_key] for block_key in outline) - overlap
+        # number and sum of ids of the students with a state in each block, to check the saved students
+        block_students = self.get_block_students(course_key, list(outline))
+        student_ids = set(str(x) for x in self.get_enrolled_student_ids(course_key))
+        course_states = self.get_course_user_states(course_key, list(outline), modified_since=modified_since, is_resumen=is_resumen)
+        next_states = next(course_states, None)
+        for block_key, block_outline in outline.items():
+            if block_key in watermarks:
+                block_rows = json.loads(block_reports.get(block_id=block_key).rows)
+            else:
+                block_rows = {}
+            watermark = watermarks.get(block_key)
+            new_watermark = watermark
+            block_item = blocks.get(block_key)
+            updated = False
+            student_states = []
+            if next_states is not None and next_states[0] == block_key:
+                student_states = next_states[1]
+                next_states = next(course_states, None)
+            if block_item is not None:
+                for response in student_states:
+                    if watermark is not None and response['modified'] <= watermark - overlap:
+                        continue
+                    block_rows[str(response['student__id'])] = list(self.get_block_rows(block_key, block_item, block_outline, [response], is_resumen))
+                    updated = True
+                    if new_watermark is None or response['modified'] > new_watermark:
+                        new_watermark = response['modified']
+                # the students who are no longer enrolled are read again if they enroll
+                for student_id in [x for x in block_rows if x not in student_ids]:
+                    del block_rows[student_id]
+                    updated = True
+                if (len(block_rows), sum(int(x) for x in block_rows)) != block_students.get(block_key, (0, 0)):
+                    updated = self.update_block_students(course_key, block_key, block_item, block_outline, block_rows, is_resumen) or updated
+            if updated:
+                XblockCompletionBlockReport.objects.update_or_create(
+                    course_id=course_key,
+                    block_id=block_key,
+                    report_format=report_format,
+                    defaults={'watermark': new_watermark, 'content_version': content_version, 'rows': json.dumps(block_rows)})
+            for student_id in sorted(block_rows, key=int):
+                if student_id in student_ids:
+                    self.write_rows(csvwriter, block_rows[student_id])
+            self.stats.block_processed(self.stats.blocks_processed + 1)
+
+    def get_block_students(self, course_key, block_keys):
+        """
+            Return block_key -> (number, sum of ids) of the enrolled students with a state with attempts in the block
+        """
+        smdat = self.filter_enrolled_students(StudentModule.objects.using(self.get_db_alias(course_key)).filter(
+            course_id=course_key,
+            module_type="problem",
+            module_state_key__in=block_keys,
+            state__contains="attempts"
+            ), course_key)
+        smdat = smdat.values('module_state_key').annotate(students=Count('student_id'), students_sum=Sum('student_id')).order_by()
+        return {x['module_state_key']: (x['students'], x['students_sum']) for x in smdat}
+
+    def update_block_students(self, course_key, block_key, block_item, block_outline, block_rows, is_resumen):
+        """
+            Make the saved students of block_rows equal to the enrolled students with a state in the block:
+            remove the deleted states and add the rows of the missing students, read without the watermark.
+            Return True if block_rows changed
+        """
+        current_ids = set(str(x) for x in self.filter_enrolled_students(StudentModule.objects.using(self.get_db_alias(course_key)).filter(
+            course_id=course_key,
+            module_type="problem",
+            module_state_key=block_key,
+            state__contains="attempts"
+            ), course_key).values_list('student_id', flat=True))
+        deleted_ids = [x for x in block_rows if x not in current_ids]
+        for student_id in deleted_ids:
+            del block_rows[student_id]
+        missing_ids = sorted(int(x) for x in current_ids if x not in block_rows)
+        chunk_size = getattr(settings, 'XBLOCKCOMPLETION_STUDENTS_CHUNK_SIZE', 5000)
+        for i in range(0, len(missing_ids), chunk_size):
+            course_states = self.get_course_user_states(course_key, [block_key], is_resumen=is_resumen, student_ids=missing_ids[i:i + chunk_size])
+            for __, student_states in course_states:
+                for response in student_states:
+                    block_rows[str(response['student__id'])] = list(self.get_block_rows(block_key, block_item, block_outline, [response], is_resumen))
+        return bool(deleted_ids or missing_ids)
+
+    def write_rows_parallel(self, course_key, outline, blocks, course_states, is_resumen, csvwriter, workers):
+        """
+            Build the rows of each block in a pool of workers (XBLOCKCOMPLETION_PARALLEL_BACKEND,
+            'thread' or 'process') and write them in course order. At most 2 * workers blocks
+            are pending at the same time
+        """
+        backend = getattr(settings, 'XBLOCKCOMPLETION_PARALLEL_BACKEND', 'thread')
+        if backend == 'process' and multiprocessing.current_process().daemon:
+            # daemonic processes (e.g. celery prefork workers) can not have children
+            logger.warning("XblockCompletion - Process pool not allowed in a daemonic process, using threads, course: {}".format(course_key))
+            backend = 'thread'
+        if backend == 'process':
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_process_worker)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        positions = {block_key: i for i, block_key in enumerate(outline)}
+        pending = deque()
+        with executor:
+            for block_key, student_states in course_states:
+                if block_key not in blocks:
                     continue
-                # assume all block_key are directly children of unit
-                block_ancestors = self.get_block_ancestors(block_item, store)
-                display_name = block_item.display_name.replace("\n", "")
-                #jump_to_url = url_base + reverse('jump_to',kwargs={
-                #            'course_id': course_id,
-                #            'location': str(block_key)})
-                # only problem block
-                if is_resumen:
-                    student_states  = self.get_user_states(course_key, block_key)
-                    for response in student_states:
-                        user_state = json.loads(response['state'])
-                        # Check if correct_map exist
-                        if user_state.get('correct_map', None) is None:
-                            continue
-                        # Total points of a block
-                        total_points = getattr(block_item, 'weight', None)
-                        if total_points is None:
-                            total_points = float( user_state['score']['raw_possible'] )
-                        # Points obtained for each question
-                        pts_question = float( total_points / len(user_state['correct_map']))
-                        report = {}
-                        report['username'] = response['student__username']
-                        report['email'] = response['student__email']
-                        report['doc_id'] = response['doc_id']
-                        report['attempts'] = user_state['attempts']
-                        report['gained'] = round(user_state['score']['raw_earned'] * pts_question, 2),
-                        report['total'] =  round(total_points, 2)
-                        row = [
-                            response['student__username'],
-                            response['student__email'],
-                            response['doc_id'],
-                            block_ancestors[2]['display_name'],
-                            block_ancestors[1]['display_name'],
-                            block_ancestors[0]['display_name'],
-                            display_name,
-                            user_state['attempts'],
-                            round(float(user_state['score']['raw_earned'] * pts_question), 2),
-                            round(float(total_points), 2),
-                            str(block_key)
-                            ]
-                        if 'has_saved_answers' in user_state and user_state['has_saved_answers']:
-                            row.append('has_saved_answers')
-                        csvwriter.writerow(row)
-                else:
-                    for response in self.generate_report_data(block_item):
-                        if response is None:
-                            continue
-                        row = [                            
-                            response['username'],
-                            response['email'],
-                            response['doc_id'],
-                            block_ancestors[2]['display_name'],
-                            block_ancestors[1]['display_name'],
-                            block_ancestors[0]['display_name'],
-                            display_name,
-                            response['question'].replace("\n", ""),
-                            response['answer'].replace("\n", ""),
-                            response['correct_answer'].replace("\n", ""),
-                            response['attempts'],
-                            response['gained'],
-                            response['possible'],
-                            response['total'],
-                            str(block_key),
-                            'has_saved_answers' if response['has_saved_answers'] else ''
-                            ]
-                        if response['state']:
-                            row.append(response['state'])
-                        csvwriter.writerow(row)
-        return csvwriter
+                # the states are read here, the database cursor is not shared with the workers
+                student_states = [
+                    dict(response, module_state_key=str(block_key))
+                    for response in student_states
+                ]
+                # the block table is not sent to process workers
+                block_item = blocks[block_key] if backend == 'thread' else None
+                pending.append((positions[block_key], executor.submit(
+                    _build_block_rows, str(course_key), str(block_key), outline[block_key], student_states, is_resumen, block_item)))
+                while len(pending) >= 2 * workers:
+                    self.write_block_result(csvwriter, *pending.popleft())
+            while pending:
+                self.write_block_result(csvwriter, *pending.popleft())
+        self.stats.blocks_processed = self.stats.blocks_total
+
+    def write_rows_pipeline(self, outline, blocks, course_states, is_resumen, csvwriter, queue_size):
+        """
+            Write the rows of the blocks in course order overlapping the database and the cpu:
+            the student states of the next blocks are read in this thread while the rows of the
+            previous blocks are built and written in a background thread. At most queue_size
+            blocks are waiting to be built
+        """
+        positions = {block_key: i for i, block_key in enumerate(outline)}
+        states_queue = queue.Queue(maxsize=queue_size)
+        errors = []
+        blocks_written = [0]
+
+        def build_rows():
+            try:
+                while True:
+                    item = states_queue.get()
+                    if item is None:
+                        return
+                    block_key, student_states = item
+                    self.write_rows(csvwriter, self.get_block_rows(block_key, blocks[block_key], outline[block_key], student_states, is_resumen))
+                    blocks_written[0] = positions[block_key] + 1
+            except Exception as e:
+                errors.append(e)
+            finally:
+                # the connections opened by the worker (e.g. get_resumen_state) are closed when it stops
+                connections.close_all()
+
+        worker = threading.Thread(target=build_rows, name='xblockcompletion-rows')
+        worker.daemon = True
+        worker.start()
+        try:
+            for block_key, student_states in course_states:
+                if block_key not in blocks:
+                    continue
+                # the states are read here, the database cursor is not shared with the worker
+                item = (block_key, list(student_states))
+                while not errors:
+                    try:
+                        states_queue.put(item, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                if errors:
+                    break
+                self.stats.block_processed(blocks_written[0])
+        finally:
+            # the worker stops after building the blocks already queued
+            while worker.is_alive():
+                try:
+                    states_queue.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            worker.join()
+        if errors:
+            raise errors[0]
+        self.stats.blocks_processed = self.stats.blocks_total
+
+    def write_block_result(self, csvwriter, position, future):
+        rows, failed_blocks = future.result()
+        self.write_rows(csvwriter, rows)
+        for block_id, (responses, error) in failed_blocks.items():
+            self.stats.block_failed(block_id, error, responses)
+        self.stats.block_processed(position + 1)
+
+    def get_block_rows(self, block_key, block_item, block_outline, student_states, is_resumen):
+        """
+            Yield the report rows of a problem block
+        """
+        display_name = block_item.display_name.replace("\n", "")
+        #jump_to_url = url_base + reverse('jump_to',kwargs={
+        #            'course_id': course_id,
+        #            'location': str(block_key)})
+        # only problem block
+        if is_resumen:
+            for response in student_states:
+                report = self.get_resumen_report(block_item, response)
+                # Check if correct_map exist
+                if report is None:
+                    continue
+                yield self.get_resumen_row(block_key, display_name, block_outline, response, report)
+        else:
+            for response in self.generate_report_data(block_item, student_states):
+                if response is None:
+                    continue
+                yield self.get_full_row(block_key, display_name, block_outline, response)
 
-    def generate_report_data(self, block):
+    def get_resumen_report(self, block_item, response):
+        """
+            Return the attempts and points of a student in a block, or None if the state has no correct_map
+        """
+        user_state = self.get_resumen_state(response)
+        if user_state is None:
+            return None
+        # Total points of a block
+        total_points = getattr(block_item, 'weight', None)
+        if total_points is None:
+            total_points = float(user_state['raw_possible'])
+        # Points obtained for each question
+        pts_question = float( total_points / user_state['correct_map_size'])
+        return {
+            'attempts': user_state['attempts'],
+            'gained': round(float(user_state['raw_earned'] * pts_question), 2),
+            'total': round(float(total_points), 2),
+            'has_saved_answers': user_state['has_saved_answers'],
+        }
+
+    def get_resumen_row(self, block_key, display_name, block_outline, response, report):
+        row = [
+            response['student__username'],
+            response['student__email'],
+            response['doc_id'],
+            block_outline['section'],
+            block_outline['subsection'],
+            block_outline['unit'],
+            display_name,
+            report['attempts'],
+            report['gained'],
+            report['total'],
+            str(block_key)
+            ]
+        if report['has_saved_answers']:
+            row.append('has_saved_answers')
+        return row
+
+    def get_full_row(self, block_key, display_name, block_outline, response):
+        row = [
+            response['username'],
+            response['email'],
+            response['doc_id'],
+            block_outline['section'],
+            block_outline['subsection'],
+            block_outline['unit'],
+            display_name,
+            response['question'].replace("\n", ""),
+            response['answer'].replace("\n", ""),
+            response['correct_answer'].replace("\n", ""),
+            response['attempts'],
+            response['gained'],
+            response['possible'],
+            response['total'],
+            str(block_key),
+            'has_saved_answers' if response['has_saved_answers'] else ''
+            ]
+        if response['state']:
+            row.append(response['state'])
+        return row
+
+    def get_resumen_state(self, response):
+        """
+            Return the fields of the student state used by the resumen report, or None if
+            the state has no correct_map. The score is read from the StudentModule grade columns
+            and the other fields are extracted by the database or from the state without
+            parsing it, the state is only parsed when a field can not be extracted
+        """
+        if 'state' in response:
+            state = response['state']
+            attempts = STATE_ATTEMPTS_RE.search(state)
+            user_state = {
+                'attempts': int(attempts.group(1)) if attempts else None,
+                'correct_map_size': _get_state_correct_map_size(state),
+                'has_saved_answers': STATE_HAS_SAVED_ANSWERS_RE.search(state) is not None,
+            }
+        else:
+            user_state = {
+                'attempts': int(response['state_attempts']) if response['state_attempts'] is not None else None,
+                'correct_map_size': response['state_correct_map_size'],
+                'has_saved_answers': response['state_has_saved_answers'] == 'true',
+            }
+        if user_state['correct_map_size'] == 0:
+            # the correct_map is null or empty
+            return None
+        user_state['raw_earned'] = response['grade']
+        user_state['raw_possible'] = response['max_grade']
+        if user_state['correct_map_size'] and None not in user_state.values():
+            return user_state
+        if 'state' not in response:
+            block_key = UsageKey.from_string(str(response['module_state_key']))
+            response['state'] = StudentModule.objects.using(self.get_db_alias(block_key.course_key)).get(
+                student_id=response['student__id'],
+                module_state_key=block_key).state
+        full_state = json.loads(response['state'])
+        if not full_state.get('correct_map', None):
+            return None
+        return {
+            'attempts': full_state['attempts'],
+            'correct_map_size': len(full_state['correct_map']),
+            'has_saved_answers': bool(full_state.get('has_saved_answers')),
+            'raw_earned': full_state['score']['raw_earned'],
+            'raw_possible': full_state['score']['raw_possible'],
+        }
+
+    def get_compiled_problem(self, block, capa_system, seed):
+        """
+            Return the compiled problem of the block for the seed, keeping only the
+            XBLOCKCOMPLETION_COMPILED_PROBLEMS_SIZE most recently used in the report
+        """
+        key = (block.location, seed)
+        compiled = self.compiled_problems.get(key)
+        if compiled is not None:
+            self.compiled_problems.move_to_end(key)
+            return compiled
+        compiled = CompiledProblem(block, capa_system, seed)
+        self.compiled_problems[key] = compiled
+        size = getattr(settings, 'XBLOCKCOMPLETION_COMPILED_PROBLEMS_SIZE', 32)
+        while len(self.compiled_problems) > size:
+            self.compiled_problems.popitem(last=False)
+        return compiled
+
+    def generate_report_data(self, block, student_states=None):
         """
         Return a list of student responses to this block in a readable way.
         Arguments:
-            user_state_iterator: iterator over UserStateClient objects.
-                E.g. the result of user_state_client.iter_all_for_block(block_key)
+            student_states: list of student states of the block,
+                E.g. the result of get_course_user_states(course_key).
+                Set to None (default) to query them with get_user_states.
             limit_responses (int|None): maximum number of responses to include.
                 Set to None (default) to include all.
         Returns:
@@ -350,7 +2096,7 @@ class XblockCompletionView(View):
             })
         https://github.com/openedx/edx-platform/blob/open-release/olive.master/xmodule/capa/capa_problem.py
         """
-        from capa.capa_problem import LoncapaProblem, LoncapaSystem
+        from capa.capa_problem import LoncapaSystem
 
         capa_system = LoncapaSystem(
             ajax_url=None,
@@ -363,8 +2109,8 @@ class XblockCompletionView(View):
             can_execute_unsafe_code=lambda: None,
             get_python_lib_zip=None,
             DEBUG=None,
-            filestore=block.runtime.resources_fs,
-            i18n=block.runtime.service(block, "i18n"),
+            filestore=block.resources_fs,
+            i18n=block.i18n,
             node_path=None,
             render_template=None,
             seed=1,
@@ -372,95 +2118,130 @@ class XblockCompletionView(View):
             xqueue=None,
             matlab_api_key=None,
         )
-        student_states  = self.get_user_states(block.location.course_key, block.location)
-        for response in student_states:
-            user_state = json.loads(response['state'])
-            if 'student_answers' not in user_state:
-                continue
+        if student_states is None:
+            student_states = self.get_user_states(block.location.course_key, block.location)
+        states = (
+            (response, user_state)
+            for response, user_state in ((x, json.loads(x['state'])) for x in student_states)
+            if 'student_answers' in user_state
+        )
+        # the states are streamed while they have the seed of the first one (e.g. a problem
+        # without randomization). In a randomized problem the other states are processed grouped
+        # by seed, so the students with the same seed use their compiled problem one after the
+        # other, and their reports are yielded in the original order
+        first_seed = None
+        for response, user_state in states:
+            if first_seed is None:
+                first_seed = str(user_state.get('seed'))
+            if str(user_state.get('seed')) != first_seed:
+                pending = [(response, user_state)] + list(states)
+                reports = [None] * len(pending)
+                for i in sorted(range(len(pending)), key=lambda i: str(pending[i][1].get('seed'))):
+                    reports[i] = list(self.get_state_reports(block, capa_system, *pending[i]))
+                for state_reports in reports:
+                    for report in state_reports:
+                        yield report
+                return
+            for report in self.get_state_reports(block, capa_system, response, user_state):
+                yield report
+
+    def get_state_reports(self, block, capa_system, response, user_state):
+        """
+            Yield the reports of the answers of a student state with student_answers
+        """
+        # a problem that fails to compile is not compiled again for the other students
+        key = (block.location, user_state.get('seed'))
+        error = self.failed_problems.get(key)
+        if error is None:
             try:
-                lcp = LoncapaProblem(
-                    problem_text=block.data,
-                    id=block.location.html_id(),
-                    capa_system=capa_system,
-                    # We choose to run without a fully initialized CapaModule
-                    capa_module=None,
-                    state={
-                        'done': user_state.get('done'),
-                        'correct_map': user_state.get('correct_map'),
-                        'student_answers': user_state.get('student_answers'),
-                        'has_saved_answers': user_state.get('has_saved_answers'),
-                        'input_state': user_state.get('input_state'),
-                        'seed': user_state.get('seed'),
-                    },
-                    seed=user_state.get('seed'),
-                    # extract_tree=False allows us to work without a fully initialized CapaModule
-                    # We'll still be able to find particular data in the XML when we need it
-                    extract_tree=False,
-                )
-                for answer_id, orig_answers in lcp.student_answers.items():
-                    # Some types of problems have data in lcp.student_answers that isn't in lcp.problem_data.
-                    # E.g. formulae do this to store the MathML version of the answer.
-                    # We exclude these rows from the report because we only need the text-only answer.
-                    if answer_id.endswith('_dynamath'):
-                        continue
-                    # Check if correct_map exist
-                    if user_state.get('correct_map', None) is None:
-                        continue
-                    question_text = lcp.find_question_label(answer_id)
-                    answer_text = lcp.find_answer_text(answer_id, current_answer=orig_answers)
-                    correct_answer_text = lcp.find_correct_answer_text(answer_id)
-
-                    report = {
-                        'answer_id': answer_id,
-                        'question': question_text or '',
-                        'answer': answer_text or '',
-                        'correct_answer': correct_answer_text or ''
-                    }
-                    # Total points of a block
-                    total_points = getattr(block, 'weight', None)
-                    if total_points is None:
-                        total_points = float(user_state['score']['raw_possible'])
-                    # Points obtained for each question
-                    pts_question = round(float( total_points  / len(user_state['correct_map'])), 2)
-                    report['username'] = response['student__username']
-                    report['email'] = response['student__email']
-                    report['doc_id'] = response['doc_id']
-                    report['attempts'] = user_state['attempts']
-                    # Points earned by the user on a particular question
-                    report['gained'] = pts_question if user_state['correct_map'][answer_id]['correctness'] == "correct" else float(0)
-                    # Possible points for each question
-                    report['possible'] = pts_question
-                    report['total'] = round(float(total_points), 2)
-                    report['has_saved_answers'] = user_state.get('has_saved_answers', None)
-                    report['state'] = None
-                    yield report
+                # students with the same seed share the compiled problem
+                with self.stats.timer('xml'):
+                    compiled = self.get_compiled_problem(block, capa_system, user_state.get('seed'))
             except Exception as e:
-                logger.error("XblockCompletionView - Error to create xml problem, block id: {}, error: {}".format(str(block.location), str(e)))
+                error = self.failed_problems[key] = str(e)
+        if error is not None:
+            self.stats.block_failed(str(block.location), error)
+            report = self.get_fallback_report(block, response, user_state)
+            if report is not None:
+                yield report
+            return
+        try:
+            for answer_id, orig_answers in user_state['student_answers'].items():
+                # Some types of problems have data in lcp.student_answers that isn't in lcp.problem_data.
+                # E.g. formulae do this to store the MathML version of the answer.
+                # We exclude these rows from the report because we only need the text-only answer.
+                if answer_id.endswith('_dynamath'):
+                    continue
                 # Check if correct_map exist
                 if user_state.get('correct_map', None) is None:
                     continue
+                with self.stats.timer('xml'):
+                    question_text = compiled.question(answer_id)
+                    answer_text = compiled.answer(answer_id, orig_answers)
+                    correct_answer_text = compiled.correct_answer(answer_id)
+
+                report = {
+                    'answer_id': answer_id,
+                    'question': question_text or '',
+                    'answer': answer_text or '',
+                    'correct_answer': correct_answer_text or ''
+                }
                 # Total points of a block
                 total_points = getattr(block, 'weight', None)
                 if total_points is None:
                     total_points = float(user_state['score']['raw_possible'])
                 # Points obtained for each question
                 pts_question = round(float( total_points  / len(user_state['correct_map'])), 2)
-                report = {
-                    'answer_id': '',
-                    'question': '',
-                    'answer': '',
-                    'correct_answer': ''
-                }
                 report['username'] = response['student__username']
                 report['email'] = response['student__email']
                 report['doc_id'] = response['doc_id']
-                report['attempts'] = user_state.get('attempts', '')
+                report['attempts'] = user_state['attempts']
+                report['correct'] = user_state['correct_map'][answer_id]['correctness'] == "correct"
                 # Points earned by the user on a particular question
-                report['gained'] = pts_question if user_state['correct_map'][answer_id]['correctness'] == "correct" else float(0)
+                report['gained'] = pts_question if report['correct'] else float(0)
                 # Possible points for each question
                 report['possible'] = pts_question
                 report['total'] = round(float(total_points), 2)
                 report['has_saved_answers'] = user_state.get('has_saved_answers', None)
-                report['state'] = response['state']
+                report['state'] = None
+                yield report
+        except Exception as e:
+            # logged once per block with the number of responses, see ReportStats.log_failed_blocks
+            self.stats.block_failed(str(block.location), str(e))
+            report = self.get_fallback_report(block, response, user_state)
+            if report is not None:
                 yield report
+
+    def get_fallback_report(self, block, response, user_state):
+        """
+            Return the response of a student to a block whose capa problem can not be read,
+            with the points of the whole block and the raw state instead of the answers
+        """
+        # Check if correct_map exist
+        if user_state.get('correct_map', None) is None:
+            return None
+        # Total points of a block
+        total_points = getattr(block, 'weight', None)
+        if total_points is None:
+            total_points = float(user_state['score']['raw_possible'])
+        # Points obtained for each question
+        pts_question = float(total_points / len(user_state['correct_map']))
+        correct = sum(1 for x in user_state['correct_map'].values() if x.get('correctness') == "correct")
+        return {
+            'answer_id': '',
+            'question': '',
+            'answer': '',
+            'correct_answer': '',
+            'username': response['student__username'],
+            'email': response['student__email'],
+            'doc_id': response['doc_id'],
+            'attempts': user_state.get('attempts', ''),
+            # Points earned by the user on the block
+            'gained': round(float(pts_question * correct), 2),
+            # Possible points of the block
+            'possible': round(float(total_points), 2),
+            'total': round(float(total_points), 2),
+            'has_saved_answers': user_state.get('has_saved_answers', None),
+            'state': response['state'],
+        }
             